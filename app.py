@@ -4,18 +4,38 @@ import base64
 import logging
 import requests
 import redis
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date as Date
 from enum import Enum
-from flask import Flask, request, Response, send_from_directory, jsonify
-import openai
-from requests.exceptions import RequestException
-from tenacity import retry, stop_after_attempt, wait_fixed
-from PIL import Image
+from flask import Flask, request, Response, send_from_directory, jsonify, stream_with_context, g
+from requests.exceptions import RequestException, HTTPError
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception
+from PIL import Image, ImageOps
 import io
 import re
-import gspread
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
+import queue
+import hashlib
+import hmac
+import csv
+import sqlite3
+import random
+import bisect
+import unicodedata
+import sys
+import time
+import signal
+import uuid
+import zlib
+import math
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import gspread   # solo para anotaciones: en ejecución se importa en el primer uso
 
 # --- Configuración de entorno ------------------------------------------------
 META_VERIFY_TOKEN     = os.getenv("META_VERIFY_TOKEN")
@@ -27,26 +47,362 @@ GOOGLE_CREDS_B64      = os.getenv("GOOGLE_CREDS_B64")
 OCR_SERVICE_URL       = os.getenv("OCR_SERVICE_URL", "https://ocr-microsistema.onrender.com/ocr")
 DERIVADOR_SERVICE_URL = os.getenv("DERIVADOR_SERVICE_URL", "https://derivador-service-onrender.com/derivar")
 GOOGLE_SHEET_NAME     = os.getenv("GOOGLE_SHEET_NAME", "ALIA_Bot_Data")
+GRAPH_API_URL         = os.getenv("GRAPH_API_URL", "https://graph.facebook.com/v16.0")
 ALIA_FOLDER_ID        = "14UsGNIz6MBhQNd0gVFeSe3UPBNyB8yrk"
-
-# --- Lista de feriados (2025 Argentina) -------------------------------------
-FERIADOS_2025 = [
-    "2025-01-01", "2025-03-03", "2025-03-04", "2025-03-24", "2025-04-02",
-    "2025-04-17", "2025-04-18", "2025-05-01", "2025-05-25", "2025-06-20",
-    "2025-07-09", "2025-08-17", "2025-10-12", "2025-11-20", "2025-12-08", "2025-12-25"
-]
+CALENDARIO_CONFIG     = os.getenv("CALENDARIO_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "calendario.json"))
+ESTUDIOS_CATALOGO     = os.getenv("ESTUDIOS_CATALOGO", os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "estudios.json"))
+INTENCIONES_CONFIG    = os.getenv("INTENCIONES_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "intenciones.json"))
+ANALYTICS_DB_PATH     = os.getenv("ANALYTICS_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "analytics.db"))
+ANALYTICS_TOKEN       = os.getenv("ANALYTICS_TOKEN")                   # sin token, la API de analytics no se expone
+WEBHOOK_MODO          = os.getenv("WEBHOOK_MODO", "sync")        # "sync" | "cola"
+WEBHOOK_WORKERS       = int(os.getenv("WEBHOOK_WORKERS", "8"))    # un shard por worker
+WEBHOOK_WORKERS_EN_WEB= os.getenv("WEBHOOK_WORKERS_EN_WEB", "1") == "1"
+WEBHOOK_BATCH_HILOS   = int(os.getenv("WEBHOOK_BATCH_HILOS", "8"))
+WEBHOOK_DEDUP_TTL     = int(os.getenv("WEBHOOK_DEDUP_TTL", "86400"))
+WEBHOOK_REINTENTOS    = int(os.getenv("WEBHOOK_REINTENTOS", "3"))      # intentos por job antes de webhook:fallidos
+SHEETS_WRITE_BEHIND   = os.getenv("SHEETS_WRITE_BEHIND", "1") == "1"
+SHEETS_BATCH_SIZE     = int(os.getenv("SHEETS_BATCH_SIZE", "20"))
+SHEETS_FLUSH_SEGUNDOS = float(os.getenv("SHEETS_FLUSH_SEGUNDOS", "10"))
+SHEETS_HANDLE_TTL     = int(os.getenv("SHEETS_HANDLE_TTL", "600"))
+CUPOS_DOMICILIO       = json.loads(os.getenv("CUPOS_DOMICILIO", '{"default": 15}'))  # por zona
+CUPOS_RECONCILIAR_SEGUNDOS = float(os.getenv("CUPOS_RECONCILIAR_SEGUNDOS", "900"))
+CUPOS_DIAS_MAX        = 60
+OPENAI_MODEL          = os.getenv("OPENAI_MODEL", "gpt-4")
+OPENAI_TIMEOUT        = float(os.getenv("OPENAI_TIMEOUT", "25"))      # segundos, por llamada
+OPENAI_CONCURRENCIA   = int(os.getenv("OPENAI_CONCURRENCIA", "8"))
+IMAGEN_LADO_MAX       = int(os.getenv("IMAGEN_LADO_MAX", "1024"))
+IMAGEN_BYTES_OK       = int(os.getenv("IMAGEN_BYTES_OK", "307200"))    # JPEG ya chico: no se recomprime
+IMAGEN_MAX_BYTES      = int(os.getenv("IMAGEN_MAX_BYTES", "10485760"))
+OCR_CACHE_TTL         = int(os.getenv("OCR_CACHE_TTL", str(7 * 86400)))
+OCR_CACHE_MAX         = int(os.getenv("OCR_CACHE_MAX", "5000"))       # entradas, se desalojan las menos usadas
+CONSULTA_CACHE_TTL    = int(os.getenv("CONSULTA_CACHE_TTL", str(7 * 86400)))  # respuestas de OpenAI a consultas libres
+HTTP_CONNECT_TIMEOUT  = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3"))
+HTTP_POOL_SIZE        = int(os.getenv("HTTP_POOL_SIZE", "20"))        # conexiones keep-alive por host
+WHATSAPP_ENVIO_MODO   = os.getenv("WHATSAPP_ENVIO_MODO", "cola")       # "cola" | "directo"
+WHATSAPP_ENVIO_SHARDS = int(os.getenv("WHATSAPP_ENVIO_SHARDS", "4"))
+WHATSAPP_MPS          = float(os.getenv("WHATSAPP_MPS", "80"))         # mensajes/s por número emisor
+WHATSAPP_REINTENTOS   = int(os.getenv("WHATSAPP_REINTENTOS", "5"))
+SLOW_REQUEST_MS       = float(os.getenv("SLOW_REQUEST_MS", "3000"))
+LOCK_CONV_TTL         = float(os.getenv("LOCK_CONV_TTL", "60"))        # segundos, vence si el proceso muere
+LOCK_CONV_ESPERA      = float(os.getenv("LOCK_CONV_ESPERA", "30"))     # espera máxima por el lock de un teléfono
+BARRIDO_SEGUNDOS      = float(os.getenv("BARRIDO_SEGUNDOS", "5"))       # pausa entre lotes del barrido de sesiones
+BARRIDO_LOTE          = int(os.getenv("BARRIDO_LOTE", "1000"))          # claves por SCAN
+CIRCUITO_FALLOS       = int(os.getenv("CIRCUITO_FALLOS", "5"))          # fallos seguidos que abren el circuito
+CIRCUITO_ESPERA       = float(os.getenv("CIRCUITO_ESPERA", "30"))      # segundos abierto antes de sondear
+CHAT_SSE_MAX          = int(os.getenv("CHAT_SSE_MAX", "8"))            # streams abiertos por proceso (cada uno ocupa un hilo)
+CHAT_SSE_VIDA         = float(os.getenv("CHAT_SSE_VIDA", "300"))       # segundos antes de cerrar el stream y que el navegador reconecte
 
 # --- Logging ---------------------------------------------------------------
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
 # --- Clientes --------------------------------------------------------------
-openai.api_key   = OPENAI_API_KEY
+# Google (gspread, Drive) y OpenAI se importan e inicializan en el primer uso
+# (ver "Clientes diferidos"): el arranque no paga esos imports ni se cae si
+# Sheets no responde.
 redis_client     = redis.from_url(REDIS_URL, decode_responses=True)
 app              = Flask(__name__, static_folder="static")
+_detener         = threading.Event()
+_contexto        = threading.local()   # estado del mensaje en curso (por hilo)
+
+# --- Métricas (formato Prometheus) -----------------------------------------
+# Con gunicorn cada worker es un proceso con sus propios contadores. Para que
+# /metrics dé el total sin importar qué worker atiende el scrape, cada
+# proceso acumula los incrementos y cada METRICAS_VOLCADO segundos los suma
+# en Redis (HINCRBYFLOAT en metricas:contadores y metricas:histogramas); los
+# gauges que cambiaron se escriben en metricas:gauges (gana el último), que
+# sirve para los que salen de Redis y valen lo mismo en todos los procesos.
+# Los gauges de estado propio del proceso (metrica_set_proceso, p. ej. el
+# estado de un circuit breaker) se escriben enteros en metricas:gauges:{id}
+# en cada volcado y el scrape publica el máximo entre los procesos vivos
+# (los que volcaron en las últimas tres vueltas). El scrape vuelca lo
+# propio, corre los colectores y arma la respuesta desde Redis; si Redis no
+# responde, cae a los valores de este proceso y alia_metricas_agregadas
+# queda en 0.
+HIST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRICAS_VOLCADO     = 5
+METRICAS_CONTADORES  = "metricas:contadores"
+METRICAS_GAUGES      = "metricas:gauges"
+METRICAS_HISTOGRAMAS = "metricas:histogramas"
+METRICAS_PROCESOS    = "metricas:procesos"     # zset id de proceso -> último volcado
+_PROCESO_METRICAS    = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+_metricas_lock = threading.Lock()
+_contadores    = defaultdict(float)
+_gauges        = {}
+_histogramas   = {}
+_colectores    = []
+_deltas_contadores  = defaultdict(float)  # incrementos todavía no sumados en Redis
+_deltas_histogramas = defaultdict(float)  # ((nombre, labels), bucket | "sum" | "count") -> incremento
+_gauges_sucios      = set()
+_gauges_proceso     = {}                      # estado propio del proceso, se agrega con max
+
+def _labels_key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def metrica_inc(nombre: str, valor: float = 1, **labels):
+    key = (nombre, _labels_key(labels))
+    with _metricas_lock:
+        _contadores[key] += valor
+        _deltas_contadores[key] += valor
+
+def metrica_set(nombre: str, valor: float, **labels):
+    key = (nombre, _labels_key(labels))
+    with _metricas_lock:
+        _gauges[key] = valor
+        _gauges_sucios.add(key)
+
+def metrica_set_proceso(nombre: str, valor: float, **labels):
+    with _metricas_lock:
+        _gauges_proceso[(nombre, _labels_key(labels))] = valor
+
+def metrica_observar(nombre: str, valor: float, **labels):
+    key = (nombre, _labels_key(labels))
+    with _metricas_lock:
+        h = _histogramas.get(key)
+        if h is None:
+            h = _histogramas[key] = {"buckets": [0] * len(HIST_BUCKETS), "sum": 0.0, "count": 0}
+        for i, limite in enumerate(HIST_BUCKETS):
+            if valor <= limite:
+                h["buckets"][i] += 1
+                _deltas_histogramas[(key, i)] += 1
+        h["sum"]   += valor
+        h["count"] += 1
+        _deltas_histogramas[(key, "sum")]   += valor
+        _deltas_histogramas[(key, "count")] += 1
+
+def registrar_colector(fn):
+    # fn() se ejecuta en cada scrape y actualiza gauges que viven fuera del proceso (Redis)
+    _colectores.append(fn)
+    return fn
+
+def _campo_metrica(key: tuple, parte=None) -> str:
+    nombre, labels = key
+    return json.dumps([nombre, labels] if parte is None else [nombre, labels, parte])
+
+def _leer_campo_metrica(campo: str) -> tuple:
+    nombre, labels, *parte = json.loads(campo)
+    return (nombre, tuple(tuple(par) for par in labels)), (parte[0] if parte else None)
+
+def volcar_metricas():
+    with _metricas_lock:
+        contadores, histogramas = dict(_deltas_contadores), dict(_deltas_histogramas)
+        gauges = {k: _gauges[k] for k in _gauges_sucios}
+        propios = dict(_gauges_proceso)
+        _deltas_contadores.clear()
+        _deltas_histogramas.clear()
+        _gauges_sucios.clear()
+    if not (contadores or histogramas or gauges or propios):
+        return
+    try:
+        # MULTI/EXEC: o se suma todo o nada, así un reintento no cuenta dos veces
+        pipe = redis_client.pipeline()
+        for key, v in contadores.items():
+            pipe.hincrbyfloat(METRICAS_CONTADORES, _campo_metrica(key), v)
+        for (key, parte), v in histogramas.items():
+            pipe.hincrbyfloat(METRICAS_HISTOGRAMAS, _campo_metrica(key, parte), v)
+        if gauges:
+            pipe.hset(METRICAS_GAUGES, mapping={_campo_metrica(k): v for k, v in gauges.items()})
+        if propios:
+            ahora, vida = time.time(), 3 * METRICAS_VOLCADO
+            clave = f"{METRICAS_GAUGES}:{_PROCESO_METRICAS}"
+            pipe.delete(clave)
+            pipe.hset(clave, mapping={_campo_metrica(k): v for k, v in propios.items()})
+            pipe.expire(clave, vida)
+            pipe.zadd(METRICAS_PROCESOS, {_PROCESO_METRICAS: ahora})
+            pipe.zremrangebyscore(METRICAS_PROCESOS, "-inf", ahora - vida)
+        pipe.execute()
+    except redis.RedisError:
+        with _metricas_lock:
+            for key, v in contadores.items():
+                _deltas_contadores[key] += v
+            for key, v in histogramas.items():
+                _deltas_histogramas[key] += v
+            _gauges_sucios.update(gauges)
+        raise
+
+def retirar_metricas_proceso():
+    # Al apagar: el estado de este proceso no sigue contando en el máximo
+    pipe = redis_client.pipeline()
+    pipe.zrem(METRICAS_PROCESOS, _PROCESO_METRICAS)
+    pipe.delete(f"{METRICAS_GAUGES}:{_PROCESO_METRICAS}")
+    pipe.execute()
+
+def _loop_volcado_metricas():
+    while not _detener.wait(METRICAS_VOLCADO):
+        try:
+            volcar_metricas()
+        except redis.RedisError as e:
+            logger.error(f"Error Redis volcando métricas: {e}")
+
+_volcador_metricas = None
+
+def iniciar_volcado_metricas():
+    global _volcador_metricas
+    if _volcador_metricas is not None:
+        return
+    with _metricas_lock:
+        if _volcador_metricas is None:
+            _volcador_metricas = threading.Thread(target=_loop_volcado_metricas, name="volcado-metricas", daemon=True)
+            _volcador_metricas.start()
+
+def _metricas_agregadas() -> tuple:
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hgetall(METRICAS_CONTADORES)
+    pipe.hgetall(METRICAS_GAUGES)
+    pipe.hgetall(METRICAS_HISTOGRAMAS)
+    pipe.zrangebyscore(METRICAS_PROCESOS, time.time() - 3 * METRICAS_VOLCADO, "+inf")
+    crudos_c, crudos_g, crudos_h, procesos = pipe.execute()
+    contadores = {_leer_campo_metrica(c)[0]: float(v) for c, v in crudos_c.items()}
+    gauges = {_leer_campo_metrica(c)[0]: float(v) for c, v in crudos_g.items()}
+    pipe = redis_client.pipeline(transaction=False)
+    for proceso in procesos:
+        pipe.hgetall(f"{METRICAS_GAUGES}:{proceso}")
+    maximos = {}
+    for propios in pipe.execute():
+        for c, v in propios.items():
+            key = _leer_campo_metrica(c)[0]
+            maximos[key] = max(float(v), maximos.get(key, float(v)))
+    gauges.update(maximos)
+    histogramas = {}
+    for c, v in crudos_h.items():
+        key, parte = _leer_campo_metrica(c)
+        h = histogramas.setdefault(key, {"buckets": [0] * len(HIST_BUCKETS), "sum": 0.0, "count": 0})
+        if parte in ("sum", "count"):
+            h[parte] = float(v)
+        elif isinstance(parte, int) and parte < len(HIST_BUCKETS):
+            h["buckets"][parte] = float(v)
+    return contadores, gauges, histogramas
+
+def _fmt_labels(labels: tuple, extra: tuple = ()) -> str:
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+def render_metricas() -> str:
+    for fn in _colectores:
+        try:
+            fn()
+        except Exception as e:
+            logger.error(f"Error en colector de métricas {fn.__name__}: {e}")
+    try:
+        volcar_metricas()
+        contadores, gauges, histogramas = _metricas_agregadas()
+        agregadas = 1
+    except redis.RedisError as e:
+        logger.error(f"Métricas sin agregar (solo este proceso): {e}")
+        with _metricas_lock:
+            contadores, gauges = dict(_contadores), {**_gauges, **_gauges_proceso}
+            histogramas = {k: {**h, "buckets": list(h["buckets"])} for k, h in _histogramas.items()}
+        agregadas = 0
+    gauges[("alia_metricas_agregadas", ())] = agregadas
+    lineas = []
+    for (nombre, labels), v in sorted(contadores.items()):
+        lineas.append(f"{nombre}{_fmt_labels(labels)} {v}")
+    for (nombre, labels), v in sorted(gauges.items()):
+        lineas.append(f"{nombre}{_fmt_labels(labels)} {v}")
+    for (nombre, labels), h in sorted(histogramas.items()):
+        for limite, c in zip(HIST_BUCKETS, h["buckets"]):
+            lineas.append(f"{nombre}_bucket{_fmt_labels(labels, (('le', limite),))} {c}")
+        lineas.append(f"{nombre}_bucket{_fmt_labels(labels, (('le', '+Inf'),))} {h['count']}")
+        lineas.append(f"{nombre}_sum{_fmt_labels(labels)} {h['sum']}")
+        lineas.append(f"{nombre}_count{_fmt_labels(labels)} {h['count']}")
+    return "\n".join(lineas) + "\n"
+
+# --- Tiempos por etapa ------------------------------------------------------
+# medir("ocr") como context manager o decorador registra la duración en
+# alia_etapa_segundos{etapa, estado, resultado}. Si hay un mensaje en curso
+# el estado es el BotState del paciente y la etapa se suma al desglose que
+# se loguea cuando el mensaje supera SLOW_REQUEST_MS.
+def registrar_etapa(etapa: str, segundos: float, resultado: str):
+    estado = getattr(_contexto, "estado", None) or "-"
+    metrica_observar("alia_etapa_segundos", segundos, etapa=etapa, estado=estado, resultado=resultado)
+    etapas = getattr(_contexto, "etapas", None)
+    if etapas is not None:
+        etapas.append((etapa, segundos))
+
+@contextmanager
+def medir(etapa: str):
+    inicio, resultado = time.time(), "ok"
+    try:
+        yield
+    except Exception:
+        resultado = "error"
+        raise
+    finally:
+        registrar_etapa(etapa, time.time() - inicio, resultado)
+
+def _desglose_etapas(etapas: list) -> str:
+    totales = defaultdict(float)
+    for etapa, segundos in etapas:
+        totales[etapa] += segundos
+    return ", ".join(f"{e}={t:.2f}s" for e, t in sorted(totales.items(), key=lambda x: -x[1]))
+
+# --- Cliente HTTP compartido ----------------------------------------------
+# Una sesión por host (Graph API, OCR, derivador, OpenAI) con su pool de
+# conexiones keep-alive, timeouts separados de conexión y lectura y un
+# histograma de latencia por host. Los reintentos los decide cada llamador.
+_sesiones_http      = {}
+_sesiones_http_lock = threading.Lock()
+
+def http_sesion(host: str) -> requests.Session:
+    sesion = _sesiones_http.get(host)
+    if sesion is None:
+        with _sesiones_http_lock:
+            sesion = _sesiones_http.get(host)
+            if sesion is None:
+                sesion = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+                sesion.mount("https://", adapter)
+                sesion.mount("http://", adapter)
+                _sesiones_http[host] = sesion
+    return sesion
+
+def http_request(metodo: str, url: str, read_timeout: float, **kwargs) -> requests.Response:
+    host = urlparse(url).netloc
+    inicio = time.time()
+    resultado = "error"
+    try:
+        resp = http_sesion(host).request(metodo, url, timeout=(HTTP_CONNECT_TIMEOUT, read_timeout), **kwargs)
+        resultado = f"{resp.status_code // 100}xx"
+        return resp
+    finally:
+        metrica_observar("alia_http_segundos", time.time() - inicio, host=host, resultado=resultado)
+
+def es_error_http_reintentable(e: Exception) -> bool:
+    if isinstance(e, HTTPError) and e.response is not None:
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return isinstance(e, RequestException)
+
+# Backoff exponencial con jitter: 0.5s, 1s, 2s... (al azar dentro de cada tramo)
+reintentar_http = retry(
+    stop=stop_after_attempt(3),
+    wait=wait_random_exponential(multiplier=0.5, max=8),
+    retry=retry_if_exception(es_error_http_reintentable),
+    reraise=True
+)
+
+# --- Clientes diferidos (Google Sheets, Drive, OpenAI) ---------------------
+# Cada cliente se construye una sola vez, bajo lock, la primera vez que se
+# pide. Si falla no queda cacheado: el próximo uso (o /readyz) reintenta.
+_clientes      = {}
+_clientes_lock = threading.RLock()
+
+def _cliente(nombre: str, construir):
+    cliente = _clientes.get(nombre)
+    if cliente is not None:
+        return cliente
+    with _clientes_lock:
+        if nombre not in _clientes:
+            inicio = time.time()
+            _clientes[nombre] = construir()
+            logger.info(f"Cliente {nombre} inicializado en {time.time() - inicio:.2f}s")
+        return _clientes[nombre]
 
-# --- Google Sheets & Drive ------------------------------------------------
 def init_google_sheets():
+    import gspread
+    from google.oauth2.service_account import Credentials
     try:
         creds_json = json.loads(base64.b64decode(GOOGLE_CREDS_B64))
         scopes = [
@@ -60,11 +416,157 @@ def init_google_sheets():
         logger.error(f"Error inicializando Google Sheets: {e}")
         raise
 
-sheets_client, sheets_creds = init_google_sheets()
+def cliente_sheets():
+    return _cliente("sheets", init_google_sheets)[0]
+
+def cliente_drive():
+    def construir():
+        from googleapiclient.discovery import build
+        creds = _cliente("sheets", init_google_sheets)[1]
+        return build("drive", "v3", credentials=creds, cache_discovery=False)
+    return _cliente("drive", construir)
+
+def cliente_openai():
+    def construir():
+        import openai
+        openai.api_key = OPENAI_API_KEY
+        openai.requestssession = http_sesion("api.openai.com")
+        return openai
+    return _cliente("openai", construir)
+
+def _gspread():
+    import gspread
+    return gspread
+
+def precalentar_clientes():
+    # En segundo plano tras el arranque, para que el primer mensaje no pague
+    # la inicialización; un fallo acá solo se registra
+    for nombre, construir in (("sheets", cliente_sheets), ("drive", cliente_drive), ("openai", cliente_openai)):
+        try:
+            construir()
+        except Exception as e:
+            logger.warning(f"No se pudo precalentar el cliente {nombre}: {e}")
+
+# --- Circuit breakers por dependencia ----------------------------------------
+# OCR, OpenAI, Sheets y derivador pasan por un breaker. Tras CIRCUITO_FALLOS
+# fallos seguidos (solo los que cuentan para es_fallo: timeouts, 429, 5xx)
+# el circuito se abre y las llamadas fallan al instante con CircuitoAbierto;
+# cada llamador tiene su camino degradado. Pasados CIRCUITO_ESPERA segundos
+# un hilo de fondo lo pone semiabierto y prueba la dependencia con una sonda
+# liviana: si responde se cierra, si no vuelve a abrirse. El estado es por
+# proceso; alia_circuito_estado (0 cerrado, 1 semiabierto, 2 abierto)
+# publica el peor entre los workers vivos (ver metrica_set_proceso).
+CIRCUITO_CERRADO, CIRCUITO_SEMIABIERTO, CIRCUITO_ABIERTO = 0, 1, 2
+_NOMBRES_CIRCUITO = {0: "cerrado", 1: "semiabierto", 2: "abierto"}
+
+_circuitos        = {}
+_sondeo_circuitos = None
+_sondeo_lock      = threading.Lock()
+
+class CircuitoAbierto(Exception):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, nombre: str, es_fallo, sonda, al_recuperar=None):
+        self.nombre        = nombre
+        self.es_fallo      = es_fallo
+        self.sonda         = sonda
+        self.al_recuperar  = al_recuperar
+        self.estado        = CIRCUITO_CERRADO
+        self.fallos        = 0
+        self.proxima_sonda = 0.0
+        self._lock         = threading.Lock()
+        _circuitos[nombre] = self
+        metrica_set_proceso("alia_circuito_estado", CIRCUITO_CERRADO, dependencia=nombre)
+
+    def abierto(self) -> bool:
+        return self.estado != CIRCUITO_CERRADO
+
+    def verificar(self):
+        if self.estado != CIRCUITO_CERRADO:
+            metrica_inc("alia_circuito_rechazos_total", dependencia=self.nombre)
+            raise CircuitoAbierto(f"{self.nombre}: circuito {_NOMBRES_CIRCUITO[self.estado]}")
+
+    def registrar(self, error: Exception = None):
+        # Un error que no es fallo (p. ej. un 400) igual prueba que la dependencia responde
+        fallo = error is not None and self.es_fallo(error)
+        with self._lock:
+            if not fallo:
+                self.fallos = 0
+                return
+            self.fallos += 1
+            if self.estado != CIRCUITO_CERRADO or self.fallos < CIRCUITO_FALLOS:
+                return
+            self._cambiar(CIRCUITO_ABIERTO)
+        logger.error(f"Circuito {self.nombre} abierto tras {CIRCUITO_FALLOS} fallos seguidos: {error}")
+        iniciar_sondeo_circuitos()
+
+    def llamar(self, fn, *args, **kwargs):
+        self.verificar()
+        try:
+            resultado = fn(*args, **kwargs)
+        except Exception as e:
+            self.registrar(e)
+            raise
+        self.registrar()
+        return resultado
+
+    def sondear(self):
+        with self._lock:
+            if self.estado != CIRCUITO_ABIERTO or time.time() < self.proxima_sonda:
+                return
+            self._cambiar(CIRCUITO_SEMIABIERTO)
+        try:
+            self.sonda()
+        except Exception as e:
+            with self._lock:
+                self._cambiar(CIRCUITO_ABIERTO)
+            logger.warning(f"Sonda de {self.nombre} fallida, el circuito sigue abierto: {e}")
+            return
+        with self._lock:
+            self.fallos = 0
+            self._cambiar(CIRCUITO_CERRADO)
+        logger.info(f"Circuito {self.nombre} cerrado: la dependencia volvió a responder")
+        if self.al_recuperar is not None:
+            try:
+                self.al_recuperar()
+            except Exception as e:
+                logger.error(f"Error al recuperar {self.nombre}: {e}")
+
+    def _cambiar(self, estado: int):
+        self.estado = estado
+        if estado == CIRCUITO_ABIERTO:
+            self.proxima_sonda = time.time() + CIRCUITO_ESPERA
+        metrica_set_proceso("alia_circuito_estado", estado, dependencia=self.nombre)
+        metrica_inc("alia_circuito_transiciones_total", dependencia=self.nombre, estado=_NOMBRES_CIRCUITO[estado])
+
+def _loop_sondeo_circuitos():
+    while not _detener.wait(1):
+        for circuito in list(_circuitos.values()):
+            circuito.sondear()
 
-def mover_a_carpeta(sheet, folder_id, creds):
+def iniciar_sondeo_circuitos():
+    global _sondeo_circuitos
+    if _sondeo_circuitos is not None:
+        return
+    with _sondeo_lock:
+        if _sondeo_circuitos is None:
+            _sondeo_circuitos = threading.Thread(target=_loop_sondeo_circuitos, name="circuitos", daemon=True)
+            _sondeo_circuitos.start()
+
+def _sonda_http(url: str, **kwargs):
+    # Cualquier respuesta que no sea 429/5xx cuenta como viva (un 405 al GET incluido)
+    resp = http_request("GET", url, 5, **kwargs)
+    try:
+        resp.raise_for_status()
+    except HTTPError as e:
+        if es_error_http_reintentable(e):
+            raise
+
+# --- Google Sheets & Drive ------------------------------------------------
+def mover_a_carpeta(sheet, folder_id: str):
     try:
-        drive = build("drive", "v3", credentials=creds)
+        drive = cliente_drive()
         file_id = sheet.id
         meta = drive.files().get(fileId=file_id, fields='parents').execute()
         prev = ",".join(meta.get('parents', []))
@@ -78,24 +580,87 @@ def mover_a_carpeta(sheet, folder_id, creds):
     except Exception as e:
         logger.error(f"Error moviendo sheet: {e}")
 
+# --- Cache de handles de Google Sheets -------------------------------------
+# Abrir un libro es una búsqueda en Drive más una lectura de metadatos; los
+# handles se cachean por (sheet_type, mes, día) durante SHEETS_HANDLE_TTL.
+# La creación de libros y pestañas faltantes pasa por un lock en Redis para
+# que dos workers no creen el mismo Sedes_YYYY-MM o YYYY-MM-DD a la vez.
+def _no_encontrado() -> tuple:
+    gspread = _gspread()
+    return (gspread.exceptions.SpreadsheetNotFound, gspread.exceptions.WorksheetNotFound)
+
+_handles_sheets = {}
+_handles_lock   = threading.Lock()
+
+def _handle_cacheado(key: tuple):
+    with _handles_lock:
+        item = _handles_sheets.get(key)
+    if item and time.time() - item[1] < SHEETS_HANDLE_TTL:
+        metrica_inc("alia_sheets_handles_total", resultado="hit")
+        return item[0]
+    metrica_inc("alia_sheets_handles_total", resultado="miss")
+    return None
+
+def _guardar_handle(key: tuple, handle):
+    with _handles_lock:
+        _handles_sheets[key] = (handle, time.time())
+    return handle
+
+def invalidar_handles_sheets():
+    with _handles_lock:
+        _handles_sheets.clear()
+
+@medir("sheets_open")
+def _abrir_o_crear(nombre: str, abrir, crear):
+    try:
+        return abrir()
+    except _no_encontrado():
+        pass
+    lock, token = f"sheets:crear:{nombre}", uuid.uuid4().hex
+    limite = time.time() + 30
+    while not redis_client.set(lock, token, nx=True, ex=60):
+        if time.time() > limite:
+            raise TimeoutError(f"Timeout esperando la creación de {nombre}")
+        time.sleep(0.5)
+        try:
+            return abrir()
+        except _no_encontrado():
+            continue
+    try:
+        try:
+            return abrir()
+        except _no_encontrado():
+            return crear()
+    finally:
+        liberar_lease(lock, token)
+
 # --- Creación de hojas mensuales y diarias ---------------------------------
-def get_monthly_sheet(date: datetime, sheet_type: str) -> gspread.Spreadsheet:
-    name = f"{sheet_type}_{date.strftime('%Y-%m')}"
-    try:
-        return sheets_client.open(name)
-    except gspread.exceptions.SpreadsheetNotFound:
-        sheet = sheets_client.create(name)
-        sheet.share(None, perm_type="anyone", role="writer")
-        mover_a_carpeta(sheet, ALIA_FOLDER_ID, sheets_creds)
-        logger.info(f"Hoja mensual creada: {name}")
-        return sheet
-
-def get_daily_worksheet(date: datetime, sheet_type: str) -> gspread.Worksheet:
+def _crear_libro(name: str) -> "gspread.Spreadsheet":
+    sheet = cliente_sheets().create(name)
+    sheet.share(None, perm_type="anyone", role="writer")
+    mover_a_carpeta(sheet, ALIA_FOLDER_ID)
+    logger.info(f"Hoja mensual creada: {name}")
+    return sheet
+
+def get_monthly_sheet(date: datetime, sheet_type: str) -> "gspread.Spreadsheet":
+    key = (sheet_type, date.strftime("%Y-%m"), None)
+    sheet = _handle_cacheado(key)
+    if sheet is None:
+        name = f"{sheet_type}_{date.strftime('%Y-%m')}"
+        sheet = _guardar_handle(key, _abrir_o_crear(
+            name, lambda: cliente_sheets().open(name), lambda: _crear_libro(name)
+        ))
+    return sheet
+
+def get_daily_worksheet(date: datetime, sheet_type: str) -> "gspread.Worksheet":
+    key = (sheet_type, date.strftime("%Y-%m"), date.strftime("%d"))
+    ws = _handle_cacheado(key)
+    if ws is not None:
+        return ws
     sheet = get_monthly_sheet(date, sheet_type)
     tab = date.strftime("%Y-%m-%d")
-    try:
-        return sheet.worksheet(tab)
-    except gspread.exceptions.WorksheetNotFound:
+
+    def crear():
         ws = sheet.add_worksheet(title=tab, rows=100, cols=25)
         headers = [
             "Timestamp", "Nombre", "DNI", "Localidad", "Dirección",
@@ -110,23 +675,201 @@ def get_daily_worksheet(date: datetime, sheet_type: str) -> gspread.Worksheet:
         logger.info(f"Pestaña creada: {tab} en {sheet.title}")
         return ws
 
-def get_resultados_sheet() -> gspread.Worksheet:
-    try:
-        book = sheets_client.open(GOOGLE_SHEET_NAME)
-        try:
-            return book.worksheet("Resultados")
-        except gspread.exceptions.WorksheetNotFound:
-            ws = book.add_worksheet(title="Resultados", rows=100, cols=20)
-            ws.append_row(["Timestamp", "Nombre", "DNI", "Localidad"] )
-            return ws
-    except gspread.exceptions.SpreadsheetNotFound:
-        book = sheets_client.create(GOOGLE_SHEET_NAME)
-        book.share(None, perm_type="anyone", role="writer")
-        mover_a_carpeta(book, ALIA_FOLDER_ID, sheets_creds)
+    return _guardar_handle(key, _abrir_o_crear(f"{sheet.title}/{tab}", lambda: sheet.worksheet(tab), crear))
+
+def get_resultados_sheet() -> "gspread.Worksheet":
+    key = ("Resultados", None, None)
+    ws = _handle_cacheado(key)
+    if ws is not None:
+        return ws
+    book = _abrir_o_crear(
+        GOOGLE_SHEET_NAME,
+        lambda: cliente_sheets().open(GOOGLE_SHEET_NAME),
+        lambda: _crear_libro(GOOGLE_SHEET_NAME)
+    )
+
+    def crear():
         ws = book.add_worksheet(title="Resultados", rows=100, cols=20)
         ws.append_row(["Timestamp", "Nombre", "DNI", "Localidad"] )
         return ws
 
+    return _guardar_handle(key, _abrir_o_crear(
+        f"{GOOGLE_SHEET_NAME}/Resultados", lambda: book.worksheet("Resultados"), crear
+    ))
+
+# --- Escritura diferida en Google Sheets -----------------------------------
+# Las filas se acumulan en Redis por destino ("Sedes:2025-06-02",
+# "Domicilios:2025-06-02" o "Resultados") y se vuelcan con append_rows al
+# llegar a SHEETS_BATCH_SIZE filas o SHEETS_FLUSH_SEGUNDOS de antigüedad.
+# Entrega al menos una vez: si el proceso muere entre append_rows y LTRIM
+# el lote se reenvía al reiniciar. Sin write-behind las filas se escriben en
+# el momento, pero si Sheets falla (o su circuito está abierto) caen a este
+# mismo buffer, así que el flusher corre siempre.
+SHEETS_DESTINOS       = "sheets:destinos"
+SHEETS_MAX_FILAS      = 500
+SHEETS_BACKOFF_MAX    = 300
+
+_LUA_CERRAR_BUFFER = """
+if redis.call('llen', KEYS[1]) == 0 then
+    redis.call('srem', KEYS[2], ARGV[1])
+    redis.call('del', KEYS[3])
+    return 1
+end
+redis.call('set', KEYS[3], ARGV[2])
+return 0
+"""
+
+_flusher_sheets      = None
+_flusher_lock        = threading.Lock()
+_flusher_despertar   = threading.Event()
+_sheets_backoff      = {}
+
+def _buffer_sheets(destino: str) -> str:
+    return f"sheets:buffer:{destino}"
+
+def _desde_sheets(destino: str) -> str:
+    return f"sheets:desde:{destino}"
+
+def destino_diario(date: datetime, sheet_type: str) -> str:
+    return f"{sheet_type}:{date.strftime('%Y-%m-%d')}"
+
+def _worksheet_destino(destino: str) -> "gspread.Worksheet":
+    if destino == "Resultados":
+        return get_resultados_sheet()
+    sheet_type, fecha = destino.split(":", 1)
+    return get_daily_worksheet(datetime.strptime(fecha, "%Y-%m-%d"), sheet_type)
+
+def encolar_fila_sheets(destino: str, row: list):
+    pipe = redis_client.pipeline()
+    pipe.rpush(_buffer_sheets(destino), json.dumps(row))
+    pipe.sadd(SHEETS_DESTINOS, destino)
+    pipe.set(_desde_sheets(destino), time.time(), nx=True)
+    pendientes = pipe.execute()[0]
+    iniciar_flusher_sheets()
+    if pendientes >= SHEETS_BATCH_SIZE:
+        _flusher_despertar.set()
+
+def filas_pendientes_sheets(destino: str) -> int:
+    return redis_client.llen(_buffer_sheets(destino))
+
+def _es_error_reintentable(e: Exception) -> bool:
+    if isinstance(e, _gspread().exceptions.APIError):
+        status = getattr(e.response, "status_code", None)
+        return status == 429 or (status or 0) >= 500
+    return isinstance(e, RequestException)
+
+def _sonda_sheets():
+    try:
+        cliente_sheets().open(GOOGLE_SHEET_NAME)
+    except _no_encontrado():
+        pass
+
+def _sheets_recuperado():
+    _sheets_backoff.clear()
+    _flusher_despertar.set()
+
+circuito_sheets = CircuitBreaker("sheets", _es_error_reintentable, _sonda_sheets, _sheets_recuperado)
+
+def _append_fila(destino: str, row: list):
+    ws = _worksheet_destino(destino)
+    with medir("sheets_append"):
+        ws.append_row(row)
+
+def escribir_fila_sheets(destino: str, row: list):
+    if not SHEETS_WRITE_BEHIND:
+        try:
+            circuito_sheets.llamar(_append_fila, destino, row)
+            return
+        except Exception as e:
+            logger.warning(f"Google Sheets no disponible, la fila de {destino} queda en cola: {e}")
+            metrica_inc("alia_sheets_filas_diferidas_total")
+    encolar_fila_sheets(destino, row)
+
+def flush_destino_sheets(destino: str) -> int:
+    lock, token = f"sheets:flush_lock:{destino}", uuid.uuid4().hex
+    if not redis_client.set(lock, token, nx=True, ex=120):
+        return 0
+    try:
+        buffer = _buffer_sheets(destino)
+        raws = redis_client.lrange(buffer, 0, SHEETS_MAX_FILAS - 1)
+        if raws:
+            inicio = time.time()
+            def volcar():
+                ws = _worksheet_destino(destino)
+                with medir("sheets_append"):
+                    ws.append_rows([json.loads(r) for r in raws])
+            circuito_sheets.llamar(volcar)
+            redis_client.ltrim(buffer, len(raws), -1)
+            metrica_observar("alia_sheets_flush_segundos", time.time() - inicio)
+            metrica_inc("alia_sheets_filas_escritas_total", len(raws))
+            logger.info(f"Volcadas {len(raws)} filas a Google Sheets ({destino})")
+        redis_client.eval(_LUA_CERRAR_BUFFER, 3, buffer, SHEETS_DESTINOS, _desde_sheets(destino),
+                          destino, time.time())
+        return len(raws)
+    finally:
+        liberar_lease(lock, token)
+
+def _destino_listo(destino: str, ahora: float) -> bool:
+    _, proximo = _sheets_backoff.get(destino, (0, 0))
+    if ahora < proximo:
+        return False
+    if filas_pendientes_sheets(destino) >= SHEETS_BATCH_SIZE:
+        return True
+    desde = redis_client.get(_desde_sheets(destino))
+    return desde is None or ahora - float(desde) >= SHEETS_FLUSH_SEGUNDOS
+
+def flush_sheets(forzar: bool = False):
+    ahora = time.time()
+    for destino in redis_client.smembers(SHEETS_DESTINOS):
+        if circuito_sheets.abierto():
+            # Las filas esperan en Redis a que la sonda cierre el circuito
+            return
+        if not forzar and not _destino_listo(destino, ahora):
+            continue
+        try:
+            flush_destino_sheets(destino)
+            _sheets_backoff.pop(destino, None)
+        except Exception as e:
+            intentos = _sheets_backoff.get(destino, (0, 0))[0] + 1
+            espera = min(SHEETS_BACKOFF_MAX, 2 ** intentos) * (0.5 + random.random() / 2)
+            if not _es_error_reintentable(e):
+                espera = SHEETS_BACKOFF_MAX
+            _sheets_backoff[destino] = (intentos, ahora + espera)
+            metrica_inc("alia_sheets_flush_errores_total")
+            invalidar_handles_sheets()
+            logger.error(f"Error volcando filas a Google Sheets ({destino}), reintento en {espera:.0f}s: {e}")
+
+def _loop_flusher_sheets():
+    while not _detener.is_set():
+        _flusher_despertar.wait(1)
+        _flusher_despertar.clear()
+        try:
+            flush_sheets()
+        except redis.RedisError as e:
+            logger.error(f"Error Redis en flusher de Google Sheets: {e}")
+    try:
+        flush_sheets(forzar=True)
+    except Exception as e:
+        logger.error(f"Error en volcado final a Google Sheets: {e}")
+
+def iniciar_flusher_sheets():
+    global _flusher_sheets
+    if _flusher_sheets is not None:
+        return
+    with _flusher_lock:
+        if _flusher_sheets is None:
+            _flusher_sheets = threading.Thread(target=_loop_flusher_sheets, name="sheets-flusher", daemon=True)
+            _flusher_sheets.start()
+
+@registrar_colector
+def _colector_backlog_sheets():
+    destinos = redis_client.smembers(SHEETS_DESTINOS)
+    pipe = redis_client.pipeline(transaction=False)
+    for destino in destinos:
+        pipe.llen(_buffer_sheets(destino))
+    metrica_set("alia_sheets_filas_pendientes", sum(pipe.execute()) if destinos else 0)
+    metrica_set("alia_sheets_destinos_pendientes", len(destinos))
+
 # --- Estados del bot -------------------------------------------------------
 class BotState(Enum):
     NONE                           = None
@@ -146,31 +889,167 @@ class BotState(Enum):
     ESPERANDO_RESULTADOS_LOCALIDAD = "esperando_resultados_localidad"
 
 # --- Funciones de sesión y Redis -------------------------------------------
+# La sesión vive en un hash paciente:{tel} (un campo JSON por dato) y solo se
+# escriben los campos que cambiaron. Durante procesar_mensaje_alia los
+# save_paciente/clear_paciente de los handlers se acumulan y se vuelcan en
+# un único pipeline al final del mensaje. La foto de la orden va aparte, en
+# paciente:{tel}:orden, con un TTL corto; si el caso termina derivado a un
+# operador, la foto viaja en la derivación (ver derivar_a_operador).
+SESION_TTL        = 86400
+SESION_IMAGEN_TTL = 3600
+
+CAMPOS_PACIENTE = (
+    "estado", "tipo_atencion", "nombre", "direccion", "localidad", "fecha_nacimiento",
+    "cobertura", "afiliado", "estudios", "imagen_hash", "dni"
+)
+
+class SesionPaciente(dict):
+    def __init__(self, tel: str, datos: dict):
+        super().__init__({c: None for c in CAMPOS_PACIENTE})
+        super().update(datos)
+        self.tel     = tel
+        self.sucios  = set()
+        self.borrada = False
+        self.fence   = None   # token del lock de conversación, si se tomó
+
+    def __setitem__(self, campo, valor):
+        super().__setitem__(campo, valor)
+        self.sucios.add(campo)
+
+    def update(self, *args, **kwargs):
+        for campo, valor in dict(*args, **kwargs).items():
+            self[campo] = valor
+
+def _key_paciente(tel: str) -> str:
+    return f"paciente:{tel}"
+
+def _key_imagen_paciente(tel: str) -> str:
+    return f"paciente:{tel}:orden"
+
 def get_paciente(tel: str) -> dict:
-    data = redis_client.get(f"paciente:{tel}")
-    if data:
-        return json.loads(data)
-    paciente = {
-        "estado": None,
-        "tipo_atencion": None,
-        "nombre": None,
-        "direccion": None,
-        "localidad": None,
-        "fecha_nacimiento": None,
-        "cobertura": None,
-        "afiliado": None,
-        "estudios": None,
-        "imagen_base64": None,
-        "dni": None
-    }
-    save_paciente(tel, paciente)
-    return paciente
+    unidad = getattr(_contexto, "unidad", None)
+    if unidad is not None and unidad.tel == tel:
+        return unidad
+    key = _key_paciente(tel)
+    try:
+        with medir("redis_get"):
+            datos = redis_client.hgetall(key)
+        return SesionPaciente(tel, {k: json.loads(v) for k, v in datos.items()})
+    except redis.ResponseError:
+        # Sesión en el formato anterior (JSON en un string): se migra al volcar
+        datos = json.loads(redis_client.get(key) or "{}")
+        datos.pop("imagen_base64", None)
+        redis_client.delete(key)
+        paciente = SesionPaciente(tel, datos)
+        paciente.sucios.update(k for k, v in datos.items() if v is not None)
+        return paciente
+
+def _volcar_paciente(tel: str, info: dict):
+    key = _key_paciente(tel)
+    if isinstance(info, SesionPaciente):
+        borrada, sucios = info.borrada, set(info.sucios)
+    else:
+        borrada, sucios = False, set(info)
+    if not borrada and not sucios:
+        return
+    escribir = {c: json.dumps(info[c]) for c in sucios if info.get(c) is not None}
+    borrar   = [c for c in sucios if info.get(c) is None]
+
+    def armar(pipe):
+        if borrada:
+            pipe.delete(key, _key_imagen_paciente(tel))
+        if borrar and not borrada:
+            pipe.hdel(key, *borrar)
+        if escribir:
+            pipe.hset(key, mapping=escribir)
+            pipe.expire(key, SESION_TTL)
+
+    fence = getattr(info, "fence", None)
+    with medir("redis_save"):
+        if fence is None:
+            pipe = redis_client.pipeline()
+            armar(pipe)
+            pipe.execute()
+        elif not _volcar_con_fence(tel, fence, armar):
+            metrica_inc("alia_conversacion_lock_total", resultado="perdido")
+            logger.error(f"Lock de conversación de {tel} vencido (fence {fence}): se descartan los cambios de sesión")
+    if isinstance(info, SesionPaciente):
+        info.sucios.clear()
+        info.borrada = False
+
+# --- Lock por conversación (un mensaje a la vez por teléfono) ----------------
+# Dos mensajes seguidos del mismo paciente pueden caer en workers distintos;
+# el lock serializa get_paciente -> handlers -> volcado por teléfono sin
+# frenar a los demás remitentes. El valor del lock es un fence creciente
+# (INCR): el volcado solo se aplica si el lock sigue siendo nuestro, así un
+# proceso que se colgó más que el TTL no pisa la sesión de quien lo siguió.
+# Mientras se procesa el mensaje el lock se renueva con lease_vivo (el fence
+# es el token), así un OCR lento no lo deja vencer: vence si el proceso muere.
+_LUA_LOCK_CONVERSACION = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return 0
+end
+local fence = redis.call('incr', KEYS[2])
+redis.call('set', KEYS[1], fence, 'PX', ARGV[1])
+redis.call('expire', KEYS[2], ARGV[2])
+return fence
+"""
+
+def _key_lock_conversacion(tel: str) -> str:
+    return f"conversacion:lock:{tel}"
+
+def adquirir_lock_conversacion(tel: str) -> int:
+    key, key_fence = _key_lock_conversacion(tel), f"conversacion:fence:{tel}"
+    inicio = time.time()
+    espera, resultado = 0.01, "libre"
+    try:
+        while True:
+            fence = redis_client.eval(_LUA_LOCK_CONVERSACION, 2, key, key_fence,
+                                      int(LOCK_CONV_TTL * 1000), SESION_TTL)
+            if fence:
+                return int(fence)
+            resultado = "contendido"
+            if time.time() - inicio + espera > LOCK_CONV_ESPERA:
+                resultado = "timeout"
+                raise TimeoutError(f"Timeout esperando el lock de conversación de {tel}")
+            time.sleep(espera * random.uniform(0.5, 1))
+            espera = min(0.25, espera * 2)
+    finally:
+        metrica_inc("alia_conversacion_lock_total", resultado=resultado)
+        registrar_etapa("lock_conversacion", time.time() - inicio, resultado)
+
+def liberar_lock_conversacion(tel: str, fence: int):
+    liberar_lease(_key_lock_conversacion(tel), str(fence))
+
+def _volcar_con_fence(tel: str, fence: int, armar) -> bool:
+    lock = _key_lock_conversacion(tel)
+    with redis_client.pipeline() as pipe:
+        try:
+            pipe.watch(lock)
+            if pipe.get(lock) != str(fence):
+                return False
+            pipe.multi()
+            armar(pipe)
+            pipe.execute()
+            return True
+        except redis.WatchError:
+            return False
 
 def save_paciente(tel: str, info: dict):
-    redis_client.set(f"paciente:{tel}", json.dumps(info), ex=86400)
+    if getattr(_contexto, "unidad", None) is info:
+        return
+    _volcar_paciente(tel, info)
 
 def clear_paciente(tel: str):
-    redis_client.delete(f"paciente:{tel}")
+    unidad = getattr(_contexto, "unidad", None)
+    if unidad is not None and unidad.tel == tel:
+        unidad.borrada = True
+        unidad.sucios.clear()
+        return
+    redis_client.delete(_key_paciente(tel), _key_imagen_paciente(tel))
+
+def guardar_imagen_paciente(tel: str, img_bytes: bytes):
+    redis_client.set(_key_imagen_paciente(tel), base64.b64encode(img_bytes).decode(), ex=SESION_IMAGEN_TTL)
 
 # --- Utilidades generales --------------------------------------------------
 def calcular_edad(fecha_str: str) -> int:
@@ -193,28 +1072,439 @@ def validate_fecha_nacimiento(fecha: str) -> bool:
 def validate_afiliado(afiliado: str) -> bool:
     return bool(re.match(r"^[a-zA-Z0-9]+$", afiliado))
 
+def normalizar_texto(texto: str) -> str:
+    # minúsculas, sin tildes y con espacios colapsados
+    texto = unicodedata.normalize("NFKD", texto or "")
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return " ".join(texto.lower().split())
+
+# --- Calendario de turnos ----------------------------------------------------
+# Feriados, días de atención por zona y sedes se leen de CALENDARIO_CONFIG.
+# Para cada zona se precalculan las fechas válidas de los próximos
+# horizonte_dias días y "próximo turno después de D" es un bisect.
+class CalendarioTurnos:
+    def __init__(self, config: dict):
+        self.horizonte = int(config.get("horizonte_dias", 180))
+        self.sin_atencion = set(config.get("dias_sin_atencion", [6]))
+        self.feriados = {Date.fromisoformat(f) for f in config.get("feriados", [])}
+        # Sin los feriados del año que alcanza el horizonte se ofrecerían turnos en feriado
+        ultimo_anio = max((f.year for f in self.feriados), default=None)
+        limite = Date.today() + timedelta(days=self.horizonte)
+        if ultimo_anio is None or limite.year > ultimo_anio:
+            logger.warning(
+                f"El horizonte de turnos llega a {limite.isoformat()} pero los feriados "
+                f"configurados terminan en {ultimo_anio}: agregar los de {limite.year} al calendario"
+            )
+        self.zonas = [
+            (nombre, [normalizar_texto(l) for l in z.get("localidades", [])], set(z["dias"]))
+            for nombre, z in config["zonas"].items()
+        ]
+        self.sedes = [
+            (nombre, sede["direccion"], [normalizar_texto(l) for l in sede.get("localidades", [])])
+            for nombre, sede in config["sedes"].items()
+        ]
+        self.sede_general = self.sedes_dict().get("GENERAL", "Nuestra sede principal")
+        self._fechas = {}
+        self._lock = threading.Lock()
+
+    def es_feriado(self, d: Date) -> bool:
+        return d in self.feriados
+
+    def zona(self, localidad: str) -> str:
+        loc = normalizar_texto(localidad)
+        for nombre, localidades, _ in self.zonas:
+            if any(l in loc for l in localidades):
+                return nombre
+        return "default"
+
+    def sede(self, localidad: str) -> tuple:
+        loc = normalizar_texto(localidad)
+        for nombre, direccion, localidades in self.sedes:
+            if any(l in loc for l in localidades):
+                return nombre, direccion
+        return "GENERAL", self.sede_general
+
+    def sedes_dict(self) -> dict:
+        return {nombre: direccion for nombre, direccion, _ in self.sedes}
+
+    def _es_valida(self, d: Date, dias: set) -> bool:
+        return d.weekday() in dias and d.weekday() not in self.sin_atencion and d not in self.feriados
+
+    def _dias_zona(self, zona: str) -> set:
+        for nombre, _, dias in self.zonas:
+            if nombre == zona:
+                return dias
+        return {0}
+
+    def fechas_zona(self, zona: str) -> list:
+        hoy = Date.today()
+        item = self._fechas.get(zona)
+        if item is None or item[0] != hoy:
+            with self._lock:
+                dias = self._dias_zona(zona)
+                fechas = [hoy + timedelta(days=i) for i in range(self.horizonte)]
+                item = self._fechas[zona] = (hoy, [d for d in fechas if self._es_valida(d, dias)])
+        return item[1]
+
+    def proxima_fecha(self, localidad: str, despues_de: Date) -> Date:
+        zona = self.zona(localidad)
+        fechas = self.fechas_zona(zona)
+        i = bisect.bisect_right(fechas, despues_de)
+        if i < len(fechas):
+            return fechas[i]
+        # Fuera del horizonte precalculado: se recorre día a día
+        dias, d = self._dias_zona(zona), max(despues_de, fechas[-1] if fechas else despues_de)
+        while True:
+            d += timedelta(days=1)
+            if self._es_valida(d, dias):
+                return d
+
+def cargar_calendario(path: str) -> CalendarioTurnos:
+    with open(path, encoding="utf-8") as f:
+        return CalendarioTurnos(json.load(f))
+
+calendario = cargar_calendario(CALENDARIO_CONFIG)
+
+def _como_datetime(d: Date) -> datetime:
+    return datetime.combine(d, datetime.min.time())
+
 def is_holiday(date: datetime) -> bool:
-    return date.strftime("%Y-%m-%d") in FERIADOS_2025
+    return calendario.es_feriado(date.date() if isinstance(date, datetime) else date)
 
 def get_next_business_day(date: datetime, localidad: str) -> tuple:
-    loc = (localidad or "").lower()
-    dias_map = { "ituzaingo":[0], "merlo":[1,4], "padua":[1,4], "tesei":[2,5], "hurlingham":[2,5], "castelar":[3] }
-    target = dias_map.get(loc, [0])
-    current = date
-    while True:
-        current += timedelta(days=1)
-        if current.weekday() == 6 or is_holiday(current):
+    current = _como_datetime(calendario.proxima_fecha(localidad, date.date()))
+    return current, current.strftime("%A")
+
+# --- Cupos de domicilio (contadores atómicos en Redis) ----------------------
+# Cada (fecha, zona) tiene un contador cupos:domicilio:YYYY-MM-DD:zona que se
+# reserva con un script Lua (comparar e incrementar), así dos pacientes no
+# pueden tomar el último cupo a la vez. El contador se siembra desde Sheets
+# la primera vez que se usa y se reconcilia periódicamente contra la hoja.
+_LUA_RESERVAR_CUPO = """
+local actual = tonumber(redis.call('get', KEYS[1]) or '0')
+if actual >= tonumber(ARGV[1]) then
+    return -1
+end
+local n = redis.call('incr', KEYS[1])
+redis.call('expire', KEYS[1], ARGV[2])
+return n
+"""
+_LUA_SUBIR_CUPO = """
+if tonumber(redis.call('get', KEYS[1]) or '0') < tonumber(ARGV[1]) then
+    redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2])
+end
+return 0
+"""
+_LUA_LIBERAR_CUPO = """
+if tonumber(redis.call('get', KEYS[1]) or '0') > 0 then
+    return redis.call('decr', KEYS[1])
+end
+return 0
+"""
+
+def zona_domicilio(localidad: str) -> str:
+    return calendario.zona(localidad)
+
+def limite_cupos_domicilio(zona: str) -> int:
+    return int(CUPOS_DOMICILIO.get(zona, CUPOS_DOMICILIO.get("default", 15)))
+
+def _key_cupo(date: datetime, zona: str) -> str:
+    return f"cupos:domicilio:{date.strftime('%Y-%m-%d')}:{zona}"
+
+def _ttl_cupo(date: datetime) -> int:
+    return max(3600, int((date + timedelta(days=2) - datetime.now()).total_seconds()))
+
+def count_domicilio_patients(date: datetime, zona: str = None) -> int:
+    registros = circuito_sheets.llamar(lambda: get_daily_worksheet(date, "Domicilios").get_all_records())
+    localidades = [r.get("Localidad", "") for r in registros]
+    buffer = _buffer_sheets(destino_diario(date, "Domicilios"))
+    localidades += [json.loads(r)[3] for r in redis_client.lrange(buffer, 0, -1)]
+    if zona is None:
+        return len(localidades)
+    return sum(1 for loc in localidades if zona_domicilio(loc) == zona)
+
+def _sembrar_cupo(date: datetime, zona: str):
+    key = _key_cupo(date, zona)
+    if redis_client.exists(key):
+        return
+    try:
+        ocupados = count_domicilio_patients(date, zona)
+    except Exception as e:
+        # Sin semilla se arranca de 0; el reconciliador corrige hacia arriba
+        logger.error(f"Error sembrando cupos {key} desde Google Sheets: {e}")
+        return
+    redis_client.set(key, ocupados, nx=True, ex=_ttl_cupo(date))
+
+def reservar_cupo_domicilio(date: datetime, localidad: str) -> bool:
+    zona = zona_domicilio(localidad)
+    _sembrar_cupo(date, zona)
+    n = redis_client.eval(_LUA_RESERVAR_CUPO, 1, _key_cupo(date, zona),
+                          limite_cupos_domicilio(zona), _ttl_cupo(date))
+    metrica_inc("alia_cupos_domicilio_reservas_total", zona=zona, resultado="ok" if n > 0 else "lleno")
+    return n > 0
+
+def liberar_cupo_domicilio(date: datetime, localidad: str):
+    redis_client.eval(_LUA_LIBERAR_CUPO, 1, _key_cupo(date, zona_domicilio(localidad)))
+
+def reconciliar_cupo(date: datetime, zona: str) -> int:
+    # Devuelve la deriva (contador - hoja). Solo baja el contador si nadie
+    # reservó mientras se leía la hoja, para no liberar un cupo recién tomado.
+    key = _key_cupo(date, zona)
+    antes = int(redis_client.get(key) or 0)
+    ocupados = count_domicilio_patients(date, zona)
+    deriva = antes - ocupados
+    if deriva < 0:
+        redis_client.eval(_LUA_SUBIR_CUPO, 1, key, ocupados, _ttl_cupo(date))
+    elif deriva > 0:
+        pipe = redis_client.pipeline()
+        try:
+            pipe.watch(key)
+            if int(pipe.get(key) or 0) == antes:
+                pipe.multi()
+                pipe.set(key, ocupados, ex=_ttl_cupo(date))
+                pipe.execute()
+        except redis.WatchError:
+            pass
+        finally:
+            pipe.reset()
+    if deriva:
+        logger.warning(f"Deriva de cupos en {key}: Redis={antes} Sheets={ocupados}")
+    metrica_set("alia_cupos_domicilio_deriva", deriva, zona=zona)
+    return deriva
+
+def reconciliar_cupos_domicilio():
+    if circuito_sheets.abierto():
+        logger.warning("Google Sheets no disponible, se saltea la reconciliación de cupos")
+        return
+    hoy = datetime.now().strftime("%Y-%m-%d")
+    for key in redis_client.scan_iter(match="cupos:domicilio:*", count=100):
+        _, _, fecha, zona = key.split(":", 3)
+        if fecha < hoy:
+            continue
+        try:
+            reconciliar_cupo(datetime.strptime(fecha, "%Y-%m-%d"), zona)
+        except Exception as e:
+            logger.error(f"Error reconciliando cupos {key}: {e}")
+
+def _loop_reconciliador_cupos():
+    token = uuid.uuid4().hex
+    while not _detener.wait(CUPOS_RECONCILIAR_SEGUNDOS):
+        try:
+            if adquirir_lease("cupos:reconciliador", token, int(CUPOS_RECONCILIAR_SEGUNDOS)):
+                reconciliar_cupos_domicilio()
+        except redis.RedisError as e:
+            logger.error(f"Error Redis reconciliando cupos: {e}")
+
+def iniciar_reconciliador_cupos():
+    threading.Thread(target=_loop_reconciliador_cupos, name="cupos-reconciliador", daemon=True).start()
+
+# --- Barrido de sesiones y reconciliación diaria -----------------------------
+# Un solo proceso a la vez (lease) recorre paciente:* con SCAN de a
+# BARRIDO_LOTE claves; el cursor queda en Redis, así que si el proceso muere
+# otro sigue desde ahí. Cada sesión tiene una inactividad máxima según su
+# estado (todo volcado renueva el TTL a SESION_TTL, así que la inactividad es
+# SESION_TTL - TTL): un saludo abandonado dura una hora, una orden a medio
+# confirmar el día entero. Una sesión con TTL ya menor o igual a su máximo
+# (acortada en una vuelta anterior) no se vuelve a tocar: ahí el TTL ya no
+# mide inactividad. Las fotos de la orden se liberan apenas la sesión
+# deja de necesitarlas. No se toca una sesión con el lock de conversación
+# tomado. Al cerrar cada vuelta se publica el embudo (sesiones por estado)
+# y, una vez por día, se reconcilian los cupos de hoy contra Sheets (la
+# deriva sale en alia_cupos_domicilio_deriva, ver reconciliar_cupo).
+BARRIDO_LEASE         = "sesiones:barrido"
+BARRIDO_CURSOR        = "sesiones:barrido:cursor"
+EMBUDO_PARCIAL        = "sesiones:embudo:parcial"
+EMBUDO_SESIONES       = "sesiones:embudo"
+RECONCILIACION_ULTIMA = "reconciliacion:ultima"
+
+INACTIVIDAD_POR_ESTADO = {
+    BotState.NONE:                            3600,
+    BotState.MENU:                            3600,
+    BotState.MENU_TURNO:                      3600,
+    BotState.ESPERANDO_NOMBRE:                6 * 3600,
+    BotState.ESPERANDO_DIRECCION:             6 * 3600,
+    BotState.ESPERANDO_LOCALIDAD:             6 * 3600,
+    BotState.ESPERANDO_FECHA_NACIMIENTO:      6 * 3600,
+    BotState.ESPERANDO_COBERTURA:             6 * 3600,
+    BotState.ESPERANDO_AFILIADO:              6 * 3600,
+    BotState.ESPERANDO_RESULTADOS_NOMBRE:     2 * 3600,
+    BotState.ESPERANDO_RESULTADOS_DNI:        2 * 3600,
+    BotState.ESPERANDO_RESULTADOS_LOCALIDAD:  2 * 3600,
+}
+_ESTADOS_CON_FOTO = {BotState.ESPERANDO_ESTUDIOS_MANUAL.value, BotState.ESPERANDO_ESTUDIOS_CONFIRMACION.value}
+
+# KEYS: sesión, foto, lock de conversación. ARGV: TTL leído, TTL nuevo.
+# Si la sesión se escribió después de leerla (TTL mayor) no se toca.
+_LUA_ACORTAR_SESION = """
+if redis.call('exists', KEYS[3]) == 1 then
+    return 0
+end
+local ttl = redis.call('ttl', KEYS[1])
+if ttl == -2 or ttl > tonumber(ARGV[1]) then
+    return 0
+end
+if tonumber(ARGV[2]) <= 0 then
+    redis.call('del', KEYS[1], KEYS[2])
+    return 2
+end
+redis.call('expire', KEYS[1], ARGV[2])
+return 1
+"""
+_LUA_BORRAR_SI_LIBRE = """
+if redis.call('exists', KEYS[2]) == 1 then
+    return 0
+end
+return redis.call('del', KEYS[1])
+"""
+
+def _estado_sesion(raw: str) -> BotState:
+    try:
+        return BotState(json.loads(raw) if raw else None)
+    except ValueError:
+        return BotState.NONE
+
+def _quitar_foto_sesion_anterior(key: str) -> bool:
+    # Sesiones en el formato anterior (JSON en un string) con la foto adentro
+    with redis_client.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            datos = json.loads(pipe.get(key) or "{}")
+            if datos.pop("imagen_base64", None) is None:
+                return False
+            ttl = pipe.ttl(key)
+            pipe.multi()
+            pipe.set(key, json.dumps(datos), ex=ttl if ttl > 0 else SESION_TTL)
+            pipe.execute()
+            return True
+        except (redis.WatchError, ValueError):
+            return False
+
+def _barrer_sesiones(keys: list) -> dict:
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.type(key)
+        pipe.ttl(key)
+    tipos = pipe.execute()
+    hashes = [(key, ttl) for key, tipo, ttl in zip(keys, tipos[::2], tipos[1::2]) if tipo == "hash" and ttl != -2]
+    for key, tipo in zip(keys, tipos[::2]):
+        if tipo == "string" and _quitar_foto_sesion_anterior(key):
+            metrica_inc("alia_sesiones_fotos_liberadas_total")
+    pipe = redis_client.pipeline(transaction=False)
+    for key, _ in hashes:
+        pipe.hget(key, "estado")
+    embudo = defaultdict(int)
+    for (key, ttl), raw in zip(hashes, pipe.execute()):
+        estado = _estado_sesion(raw)
+        maximo = INACTIVIDAD_POR_ESTADO.get(estado, SESION_TTL)
+        restante = maximo - (SESION_TTL - ttl) if ttl > 0 else maximo
+        if 0 < ttl <= maximo or (ttl > 0 and restante >= ttl):
+            embudo[estado.name] += 1
+            continue
+        tel = key.split(":", 1)[1]
+        r = redis_client.eval(_LUA_ACORTAR_SESION, 3, key, _key_imagen_paciente(tel), _key_lock_conversacion(tel),
+                              ttl, max(0, restante))
+        if r == 2:
+            metrica_inc("alia_sesiones_expiradas_total", estado=estado.name)
+        else:
+            embudo[estado.name] += 1
+            if r == 1:
+                metrica_inc("alia_sesiones_acortadas_total", estado=estado.name)
+    return embudo
+
+def _barrer_fotos(keys: list):
+    # Una foto vive mientras la sesión esté confirmando estudios; las más
+    # nuevas que LOCK_CONV_TTL pueden ser de un mensaje que todavía no volcó
+    tels = [k.split(":")[1] for k in keys]
+    pipe = redis_client.pipeline(transaction=False)
+    for key, tel in zip(keys, tels):
+        pipe.ttl(key)
+        pipe.hget(_key_paciente(tel), "estado")
+    datos = pipe.execute(raise_on_error=False)
+    for key, tel, ttl, raw in zip(keys, tels, datos[::2], datos[1::2]):
+        if isinstance(raw, Exception) or ttl < 0 or SESION_IMAGEN_TTL - ttl < LOCK_CONV_TTL:
             continue
-        if current.weekday() in target:
-            return current, current.strftime("%A")
+        if _estado_sesion(raw).value not in _ESTADOS_CON_FOTO:
+            if redis_client.eval(_LUA_BORRAR_SI_LIBRE, 2, key, _key_lock_conversacion(tel)):
+                metrica_inc("alia_sesiones_fotos_liberadas_total")
 
-def count_domicilio_patients(date: datetime) -> int:
+def barrer_lote_sesiones(cursor: int) -> int:
+    cursor, keys = redis_client.scan(cursor, match="paciente:*", count=BARRIDO_LOTE)
+    sesiones = [k for k in keys if k.count(":") == 1]
+    fotos = [k for k in keys if k.endswith(":orden")]
+    embudo = _barrer_sesiones(sesiones) if sesiones else {}
+    if fotos:
+        _barrer_fotos(fotos)
+    if embudo:
+        pipe = redis_client.pipeline(transaction=False)
+        for estado, n in embudo.items():
+            pipe.hincrby(EMBUDO_PARCIAL, estado, n)
+        pipe.execute()
+    return int(cursor)
+
+def cerrar_vuelta_barrido():
+    if redis_client.exists(EMBUDO_PARCIAL):
+        redis_client.rename(EMBUDO_PARCIAL, EMBUDO_SESIONES)
+    else:
+        redis_client.delete(EMBUDO_SESIONES)
+    hoy = datetime.now()
+    marca = f"reconciliacion:{hoy.strftime('%Y-%m-%d')}"
+    if circuito_sheets.abierto() or not redis_client.set(marca, 1, nx=True, ex=2 * 86400):
+        return
     try:
-        ws = get_daily_worksheet(date, "Domicilios")
-        return len(ws.get_all_records())
+        reconciliar_dia(hoy)
     except Exception as e:
-        logger.error(f"Error contando domicilio: {e}")
-        return 0
+        redis_client.delete(marca)
+        logger.error(f"Error en la reconciliación diaria, se reintenta en la próxima vuelta: {e}")
+
+def reconciliar_dia(date: datetime) -> dict:
+    # Cupos de Redis contra la pestaña Domicilios del día y filas del
+    # buffer de Sheets que siguen sin volcar de días anteriores
+    fecha = date.strftime("%Y-%m-%d")
+    resumen = {"fecha": fecha, "filas_atrasadas": 0}
+    for zona in sorted({nombre for nombre, _, _ in calendario.zonas}):
+        if redis_client.exists(_key_cupo(date, zona)):
+            resumen[f"deriva:{zona}"] = reconciliar_cupo(date, zona)
+    for destino in redis_client.smembers(SHEETS_DESTINOS):
+        if destino != "Resultados" and destino.split(":", 1)[1] < fecha:
+            resumen["filas_atrasadas"] += filas_pendientes_sheets(destino)
+    pipe = redis_client.pipeline()
+    pipe.delete(RECONCILIACION_ULTIMA)
+    pipe.hset(RECONCILIACION_ULTIMA, mapping=resumen)
+    pipe.execute()
+    derivas = {k[7:]: v for k, v in resumen.items() if k.startswith("deriva:") and v}
+    if derivas or resumen["filas_atrasadas"]:
+        logger.warning(f"Reconciliación {fecha}: deriva de cupos {derivas}, {resumen['filas_atrasadas']} filas atrasadas en el buffer")
+    else:
+        logger.info(f"Reconciliación {fecha}: cupos y buffer de Sheets al día")
+    return resumen
+
+def _loop_barrido_sesiones():
+    token = uuid.uuid4().hex
+    while not _detener.wait(BARRIDO_SEGUNDOS):
+        try:
+            if not adquirir_lease(BARRIDO_LEASE, token, int(max(30, 3 * BARRIDO_SEGUNDOS))):
+                continue
+            cursor = barrer_lote_sesiones(int(redis_client.get(BARRIDO_CURSOR) or 0))
+            redis_client.set(BARRIDO_CURSOR, cursor)
+            if cursor == 0:
+                cerrar_vuelta_barrido()
+        except redis.RedisError as e:
+            logger.error(f"Error Redis en el barrido de sesiones: {e}")
+        except Exception as e:
+            # Una sesión con datos inesperados no puede matar el hilo
+            logger.error(f"Error en el barrido de sesiones: {e}")
+
+def iniciar_barrido_sesiones():
+    threading.Thread(target=_loop_barrido_sesiones, name="sesiones-barrido", daemon=True).start()
+
+@registrar_colector
+def _colector_embudo_sesiones():
+    conteo = redis_client.hgetall(EMBUDO_SESIONES)
+    for estado in BotState:
+        metrica_set("alia_sesiones", int(conteo.get(estado.name, 0)), estado=estado.name)
+    atrasadas = redis_client.hget(RECONCILIACION_ULTIMA, "filas_atrasadas")
+    if atrasadas is not None:
+        metrica_set("alia_sheets_filas_atrasadas", int(atrasadas))
 
 def siguiente_campo_faltante(paciente: dict) -> str:
     pasos = [
@@ -232,70 +1522,255 @@ def siguiente_campo_faltante(paciente: dict) -> str:
     return None
     
 def determinar_dia_turno(localidad: str) -> tuple:
-    loc = (localidad or "").lower()
-    today = datetime.today()
-    if "ituzaingo" in loc:
-        dias = [0]
-    elif "merlo" in loc or "padua" in loc:
-        dias = [1,4]
-    elif "tesei" in loc or "hurlingham" in loc:
-        dias = [2,5]
-    elif "castelar" in loc:
-        dias = [3]
-    else:
-        dias = [0]
-    cd = today
-    while True:
-        cd += timedelta(days=1)
-        if cd.weekday() == 6 or is_holiday(cd):
-            continue
-        if cd.weekday() in dias:
-            return cd, cd.strftime("%A").capitalize()
+    cd = _como_datetime(calendario.proxima_fecha(localidad, Date.today()))
+    return cd, cd.strftime("%A").capitalize()
 
 def determinar_sede(localidad: str) -> tuple:
-    loc = (localidad or "").lower()
-    if loc in ["castelar","ituzaingo","moron"]:
-        return "CASTELAR","Arias 2530"
-    if loc in ["merlo","padua","paso del rey"]:
-        return "MERLO","Jujuy 847"
-    if loc in ["tesei","hurlingham"]:
-        return "TESEI","Concepción Arenal 2694"
-    return "GENERAL","Nuestra sede principal"
+    return calendario.sede(localidad)
 
 # --- Registro en Google Sheets ----------------------------------------------
 def registrar_turno(paciente: dict, date: datetime, sheet_type: str, sede: str=None):
+    emitir_parcial("estado", "Registrando tu turno…")
     try:
-        ws = get_daily_worksheet(date, sheet_type)
         ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         estudios = paciente.get("estudios") or []
         estudios_str = ", ".join(estudios) if isinstance(estudios, list) else estudios
         row = [
             ts, paciente.get("nombre",""), paciente.get("dni",""),
-            paciente.get("localidad",""), paciente.get("dirección",""),
+            paciente.get("localidad",""), paciente.get("direccion",""),
             paciente.get("fecha_nacimiento",""), calcular_edad(paciente.get("fecha_nacimiento","")) or "",
             paciente.get("cobertura",""), paciente.get("afiliado",""),
             estudios_str, paciente.get("tipo_atencion","")
         ]
         if sheet_type == "Sedes":
             row.append(sede or "")
-        ws.append_row(row)
+        escribir_fila_sheets(destino_diario(date, sheet_type), row)
+        registrar_evento_analytics("turno", sheet_type, date.strftime("%Y-%m-%d"), row)
         logger.info(f"Turno registrado para {paciente.get('nombre')} en {sheet_type} ({date.strftime('%Y-%m-%d')})")
+        return True
     except Exception as e:
         logger.error(f"Error registrando turno en Google Sheets: {e}")
+        return False
 
 def registrar_resultado(paciente: dict):
     try:
-        ws = get_resultados_sheet()
         ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         row = [ts, paciente.get("nombre",""), paciente.get("dni",""), paciente.get("localidad","")]
-        ws.append_row(row)
+        escribir_fila_sheets("Resultados", row)
+        registrar_evento_analytics("resultado", "Resultados", ts[:10], row)
         logger.info(f"Solicitud de resultado registrada para {paciente.get('nombre')}")
     except Exception as e:
         logger.error(f"Error registrando resultado en Google Sheets: {e}")
 
+# --- Store analítico (SQLite) -----------------------------------------------
+# Copia append-only de cada turno y pedido de resultados para reportes sin
+# recorrer pestañas de Sheets. Sin datos personales: ni nombre, DNI,
+# dirección, nacimiento ni afiliado. El id es el sha256 de la fila tal como
+# va a Sheets, así el backfill desde las planillas no duplica lo que la app
+# ya registró (INSERT OR IGNORE). Una conexión por hilo, en modo WAL.
+_SCHEMA_ANALYTICS = """
+CREATE TABLE IF NOT EXISTS eventos (
+    id            TEXT PRIMARY KEY,
+    tipo          TEXT NOT NULL,      -- turno | resultado
+    destino       TEXT NOT NULL,      -- Sedes | Domicilios | Resultados
+    registrado    TEXT NOT NULL,      -- timestamp de la fila
+    fecha_turno   TEXT NOT NULL,      -- YYYY-MM-DD (día del pedido para resultados)
+    tipo_atencion TEXT,
+    sede          TEXT,
+    zona          TEXT,
+    localidad     TEXT,
+    cobertura     TEXT,
+    edad          INTEGER
+);
+CREATE TABLE IF NOT EXISTS evento_estudios (
+    evento_id TEXT NOT NULL REFERENCES eventos(id),
+    estudio   TEXT NOT NULL,
+    PRIMARY KEY (evento_id, estudio)
+);
+CREATE INDEX IF NOT EXISTS eventos_zona ON eventos (destino, fecha_turno, zona);
+CREATE INDEX IF NOT EXISTS eventos_sede ON eventos (destino, fecha_turno, sede);
+CREATE INDEX IF NOT EXISTS estudios_estudio ON evento_estudios (estudio);
+"""
+
+_analytics_local       = threading.local()
+_analytics_schema_listo = False   # el schema se crea una vez por proceso
+_analytics_schema_lock  = threading.Lock()
+
+def _asegurar_schema_analytics(conn: sqlite3.Connection):
+    global _analytics_schema_listo
+    if _analytics_schema_listo:
+        return
+    with _analytics_schema_lock:
+        if not _analytics_schema_listo:
+            conn.executescript(_SCHEMA_ANALYTICS)
+            _analytics_schema_listo = True
+
+def analytics_conn() -> sqlite3.Connection:
+    conn = getattr(_analytics_local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(ANALYTICS_DB_PATH) or ".", exist_ok=True)
+        conn = sqlite3.connect(ANALYTICS_DB_PATH, timeout=5)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _asegurar_schema_analytics(conn)
+        _analytics_local.conn = conn
+    return conn
+
+def evento_desde_fila(tipo: str, destino: str, fecha_turno: str, fila: list) -> dict:
+    # fila con el layout de registrar_turno / registrar_resultado
+    celdas = ["" if c is None else str(c) for c in fila]
+    while celdas and celdas[-1] == "":
+        celdas.pop()
+    id_evento = hashlib.sha256(json.dumps([tipo, destino, fecha_turno, celdas]).encode()).hexdigest()
+    celdas += [""] * (12 - len(celdas))
+    evento = {
+        "id": id_evento, "tipo": tipo, "destino": destino, "registrado": celdas[0],
+        "fecha_turno": fecha_turno, "localidad": celdas[3] or None,
+        "tipo_atencion": None, "sede": None, "zona": None, "cobertura": None, "edad": None, "estudios": []
+    }
+    if tipo == "turno":
+        evento.update({
+            "tipo_atencion": celdas[10] or None,
+            "sede": (celdas[11] or None) if destino == "Sedes" else None,
+            "zona": zona_domicilio(celdas[3]) if destino == "Domicilios" else None,
+            "cobertura": celdas[7] or None,
+            "edad": int(celdas[6]) if celdas[6].isdigit() else None,
+            "estudios": sorted({normalizar_texto(e) for e in celdas[9].split(",") if e.strip()}),
+        })
+    return evento
+
+def guardar_eventos_analytics(eventos: list) -> int:
+    conn = analytics_conn()
+    columnas = ("id", "tipo", "destino", "registrado", "fecha_turno", "tipo_atencion",
+                "sede", "zona", "localidad", "cobertura", "edad")
+    nuevos = 0
+    with conn:
+        for ev in eventos:
+            cur = conn.execute(
+                f"INSERT OR IGNORE INTO eventos ({', '.join(columnas)}) VALUES ({', '.join('?' * len(columnas))})",
+                [ev[c] for c in columnas]
+            )
+            if cur.rowcount:
+                nuevos += 1
+                conn.executemany(
+                    "INSERT OR IGNORE INTO evento_estudios (evento_id, estudio) VALUES (?, ?)",
+                    [(ev["id"], e) for e in ev["estudios"]]
+                )
+    return nuevos
+
+def registrar_evento_analytics(tipo: str, destino: str, fecha_turno: str, fila: list):
+    # Nunca rompe el flujo del paciente: la fuente de verdad sigue siendo Sheets
+    try:
+        guardar_eventos_analytics([evento_desde_fila(tipo, destino, fecha_turno, fila)])
+        metrica_inc("alia_analytics_eventos_total", tipo=tipo, resultado="ok")
+    except Exception as e:
+        metrica_inc("alia_analytics_eventos_total", tipo=tipo, resultado="error")
+        logger.error(f"Error registrando evento analítico ({tipo}): {e}")
+
+def capacidad_domicilios(desde: str, hasta: str) -> list:
+    filas = analytics_conn().execute(
+        "SELECT fecha_turno, zona, COUNT(*) AS turnos FROM eventos "
+        "WHERE destino = 'Domicilios' AND fecha_turno BETWEEN ? AND ? "
+        "GROUP BY fecha_turno, zona ORDER BY fecha_turno, zona", (desde, hasta)
+    ).fetchall()
+    return [
+        {**dict(f), "cupo": limite_cupos_domicilio(f["zona"]),
+         "libres": max(0, limite_cupos_domicilio(f["zona"]) - f["turnos"])}
+        for f in filas
+    ]
+
+def turnos_por_sede(desde: str, hasta: str) -> list:
+    return [dict(f) for f in analytics_conn().execute(
+        "SELECT fecha_turno, sede, COUNT(*) AS turnos FROM eventos "
+        "WHERE destino = 'Sedes' AND fecha_turno BETWEEN ? AND ? "
+        "GROUP BY fecha_turno, sede ORDER BY fecha_turno, sede", (desde, hasta)
+    )]
+
+def frecuencia_estudios(desde: str, hasta: str, limite: int = 50) -> list:
+    return [dict(f) for f in analytics_conn().execute(
+        "SELECT s.estudio, COUNT(*) AS pedidos FROM evento_estudios s "
+        "JOIN eventos e ON e.id = s.evento_id "
+        "WHERE e.fecha_turno BETWEEN ? AND ? "
+        "GROUP BY s.estudio ORDER BY pedidos DESC, s.estudio LIMIT ?", (desde, hasta, limite)
+    )]
+
+def exportar_eventos(desde: str, hasta: str):
+    cur = analytics_conn().execute(
+        "SELECT e.*, (SELECT group_concat(estudio, ', ') FROM evento_estudios WHERE evento_id = e.id) AS estudios "
+        "FROM eventos e WHERE e.fecha_turno BETWEEN ? AND ? ORDER BY e.fecha_turno, e.registrado", (desde, hasta)
+    )
+    for fila in cur:
+        yield dict(fila)
+
+def _meses(desde: str, hasta: str) -> list:
+    mes, fin = datetime.strptime(desde, "%Y-%m"), datetime.strptime(hasta, "%Y-%m")
+    meses = []
+    while mes <= fin:
+        meses.append(mes.strftime("%Y-%m"))
+        mes = (mes + timedelta(days=32)).replace(day=1)
+    return meses
+
+def backfill_analytics(desde: str, hasta: str) -> int:
+    # Importa las planillas existentes; se puede correr varias veces
+    leer = retry(
+        stop=stop_after_attempt(6),
+        wait=wait_random_exponential(multiplier=2, max=60),
+        retry=retry_if_exception(_es_error_reintentable),
+        reraise=True
+    )(lambda ws: ws.get_all_values())
+    total = 0
+    for mes in _meses(desde, hasta):
+        for destino in ("Sedes", "Domicilios"):
+            try:
+                libro = cliente_sheets().open(f"{destino}_{mes}")
+            except _no_encontrado():
+                continue
+            for ws in libro.worksheets():
+                try:
+                    datetime.strptime(ws.title, "%Y-%m-%d")
+                except ValueError:
+                    continue
+                eventos = [evento_desde_fila("turno", destino, ws.title, f) for f in leer(ws)[1:] if any(f)]
+                nuevos = guardar_eventos_analytics(eventos)
+                total += nuevos
+                logger.info(f"Backfill {libro.title}/{ws.title}: {nuevos} nuevos de {len(eventos)}")
+    try:
+        ws = cliente_sheets().open(GOOGLE_SHEET_NAME).worksheet("Resultados")
+        eventos = [
+            evento_desde_fila("resultado", "Resultados", f[0][:10], f) for f in leer(ws)[1:]
+            if any(f) and desde <= f[0][:7] <= hasta
+        ]
+        total += guardar_eventos_analytics(eventos)
+    except _no_encontrado():
+        pass
+    return total
+
 # --- Envío de WhatsApp (Cloud API) -------------------------------------------
-def enviar_mensaje_whatsapp(to_number: str, body_text: str):
-    url = f"https://graph.facebook.com/v16.0/{META_PHONE_NUMBER_ID}/messages"
+WHATSAPP_MAX_CHARS = 4096
+
+def dividir_mensaje(texto: str, limite: int = WHATSAPP_MAX_CHARS) -> list:
+    # Corta por párrafo, después por línea, después por palabra; nunca a mitad
+    # de palabra salvo que una sola palabra supere el límite.
+    partes = []
+    texto = (texto or "").strip()
+    while len(texto) > limite:
+        corte = -1
+        for sep in ("\n\n", "\n", " "):
+            corte = texto.rfind(sep, 0, limite)
+            if corte > 0:
+                break
+        if corte <= 0:
+            corte = limite
+        partes.append(texto[:corte].rstrip())
+        texto = texto[corte:].lstrip()
+    if texto:
+        partes.append(texto)
+    return partes
+
+@medir("whatsapp_send")
+def _post_whatsapp(to_number: str, body_text: str):
+    url = f"{GRAPH_API_URL}/{META_PHONE_NUMBER_ID}/messages"
     headers = {
         "Authorization": f"Bearer {META_ACCESS_TOKEN}",
         "Content-Type": "application/json"
@@ -306,48 +1781,745 @@ def enviar_mensaje_whatsapp(to_number: str, body_text: str):
         "type": "text",
         "text": {"body": body_text}
     }
+    resp = http_request("POST", url, 5, headers=headers, json=data)
+    resp.raise_for_status()
+
+def enviar_mensaje_whatsapp(to_number: str, body_text: str):
+    partes = dividir_mensaje(body_text)
+    if WHATSAPP_ENVIO_MODO == "cola":
+        try:
+            encolar_envio_whatsapp(to_number, partes)
+            return
+        except redis.RedisError as e:
+            logger.error(f"Error encolando envío a {to_number}, se envía directo: {e}")
+    for parte in partes:
+        try:
+            _post_whatsapp(to_number, parte)
+            metrica_inc("alia_whatsapp_envios_total", resultado="ok")
+            logger.info(f"Mensaje enviado a {to_number}")
+        except RequestException as e:
+            metrica_inc("alia_whatsapp_envios_total", resultado="error")
+            logger.error(f"Error enviando mensaje a {to_number}: {e}")
+            return
+
+# --- Despachador de salida de WhatsApp (Redis streams) -----------------------
+# Cada destinatario cae siempre en el mismo stream y cada stream tiene un
+# único despachador (lease), así las partes y los mensajes salen en orden.
+# El lease se renueva con lease_vivo mientras se despacha la tanda y se
+# comprueba antes de cada envío: si se perdió, se corta la tanda.
+# Un token bucket compartido en Redis respeta el throughput del número
+# emisor; 429/5xx se reintentan con backoff y lo que se agota va a
+# whatsapp:salida:fallidos.
+WHATSAPP_GRUPO     = "despachadores"
+WHATSAPP_FALLIDOS  = "whatsapp:salida:fallidos"
+WHATSAPP_LEASE_TTL = 60
+
+_LUA_TOKEN_BUCKET = """
+local tasa, capacidad = tonumber(ARGV[1]), tonumber(ARGV[2])
+local t = redis.call('time')
+local ahora = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local b = redis.call('hmget', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(b[1]) or capacidad
+local ts = tonumber(b[2]) or ahora
+tokens = math.min(capacidad, tokens + (ahora - ts) * tasa)
+local espera = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    espera = (1 - tokens) / tasa
+end
+redis.call('hset', KEYS[1], 'tokens', tokens, 'ts', ahora)
+redis.call('expire', KEYS[1], 60)
+return tostring(espera)
+"""
+
+def _stream_salida(shard: int) -> str:
+    return f"whatsapp:salida:{shard}"
+
+def encolar_envio_whatsapp(to_number: str, partes: list):
+    stream = _stream_salida(shard_de(to_number, WHATSAPP_ENVIO_SHARDS))
+    pipe = redis_client.pipeline()
+    for parte in partes:
+        pipe.xadd(stream, {"to": to_number, "texto": parte, "encolado": time.time()}, maxlen=100000)
+    pipe.execute()
+    iniciar_despachadores_whatsapp()
+
+def _esperar_token_whatsapp():
+    while not _detener.is_set():
+        espera = float(redis_client.eval(_LUA_TOKEN_BUCKET, 1, f"whatsapp:bucket:{META_PHONE_NUMBER_ID}",
+                                         WHATSAPP_MPS, WHATSAPP_MPS))
+        if espera <= 0:
+            return
+        _detener.wait(espera)
+
+def _despachar_entrada(stream: str, entry_id: str, campos: dict):
+    to_number = campos["to"]
+    for intento in range(1, WHATSAPP_REINTENTOS + 1):
+        _esperar_token_whatsapp()
+        try:
+            _post_whatsapp(to_number, campos["texto"])
+            metrica_inc("alia_whatsapp_envios_total", resultado="ok")
+            metrica_observar("alia_whatsapp_entrega_segundos", time.time() - float(campos["encolado"]))
+            logger.info(f"Mensaje enviado a {to_number}")
+            break
+        except RequestException as e:
+            if not es_error_http_reintentable(e) or intento == WHATSAPP_REINTENTOS or _detener.is_set():
+                metrica_inc("alia_whatsapp_envios_total", resultado="fallido")
+                logger.error(f"Error enviando mensaje a {to_number}, se descarta tras {intento} intentos: {e}")
+                redis_client.xadd(WHATSAPP_FALLIDOS, {**campos, "error": str(e)[:500]}, maxlen=10000)
+                break
+            metrica_inc("alia_whatsapp_envios_total", resultado="reintento")
+            _detener.wait(min(30, 0.5 * 2 ** intento) * random.uniform(0.5, 1))
+    pipe = redis_client.pipeline()
+    pipe.xack(stream, WHATSAPP_GRUPO, entry_id)
+    pipe.xdel(stream, entry_id)
+    pipe.execute()
+
+def _asegurar_grupo(stream: str):
     try:
-        resp = requests.post(url, headers=headers, json=data, timeout=5)
-        resp.raise_for_status()
-        logger.info(f"Mensaje enviado a {to_number}")
-    except RequestException as e:
-        logger.error(f"Error enviando mensaje a {to_number}: {e}")
+        redis_client.xgroup_create(stream, WHATSAPP_GRUPO, id="0", mkstream=True)
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+def despachador_whatsapp(shard: int):
+    stream, lease, token = _stream_salida(shard), f"whatsapp:lease:{shard}", uuid.uuid4().hex
+    pendientes = True
+    while not _detener.is_set():
+        try:
+            if not adquirir_lease(lease, token, WHATSAPP_LEASE_TTL):
+                pendientes = True
+                _detener.wait(WHATSAPP_LEASE_TTL / 3)
+                continue
+            _asegurar_grupo(stream)
+            # Primero lo entregado y no confirmado por un despachador anterior
+            desde = "0" if pendientes else ">"
+            resp = redis_client.xreadgroup(WHATSAPP_GRUPO, "despachador", {stream: desde},
+                                           count=10, block=None if pendientes else 1000)
+            entradas = resp[0][1] if resp else []
+            if pendientes and not entradas:
+                pendientes = False
+            with lease_vivo(lease, token, WHATSAPP_LEASE_TTL) as perdido:
+                for entry_id, campos in entradas:
+                    if perdido.is_set():
+                        logger.error(f"Despachador de WhatsApp {shard} perdió el lease; se corta la tanda")
+                        pendientes = True
+                        break
+                    _despachar_entrada(stream, entry_id, campos)
+        except redis.RedisError as e:
+            logger.error(f"Error Redis en despachador de WhatsApp {shard}: {e}")
+            _detener.wait(1)
+    liberar_lease(lease, token)
+
+_despachadores_whatsapp = []
+_despachadores_lock     = threading.Lock()
+
+def iniciar_despachadores_whatsapp():
+    if _despachadores_whatsapp or WHATSAPP_ENVIO_MODO != "cola":
+        return
+    with _despachadores_lock:
+        if _despachadores_whatsapp:
+            return
+        for shard in range(WHATSAPP_ENVIO_SHARDS):
+            t = threading.Thread(target=despachador_whatsapp, args=(shard,), name=f"whatsapp-{shard}", daemon=True)
+            t.start()
+            _despachadores_whatsapp.append(t)
+    logger.info(f"Despachadores de WhatsApp iniciados: {WHATSAPP_ENVIO_SHARDS}")
+
+@registrar_colector
+def _colector_salida_whatsapp():
+    pipe = redis_client.pipeline(transaction=False)
+    for shard in range(WHATSAPP_ENVIO_SHARDS):
+        pipe.xlen(_stream_salida(shard))
+    pipe.xlen(WHATSAPP_FALLIDOS)
+    largos = pipe.execute()
+    metrica_set("alia_whatsapp_salida_pendientes", sum(largos[:-1]))
+    metrica_set("alia_whatsapp_salida_fallidos", largos[-1])
 
 # --- Derivación a operador externa -------------------------------------------
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
+# Si el derivador no responde (o su circuito está abierto) el caso queda en
+# una lista de Redis y se reenvía cuando la sonda cierra el circuito o tras
+# la próxima derivación exitosa.
+DERIVADOR_PENDIENTES     = "derivador:pendientes"
+DERIVADOR_PENDIENTES_MAX = 1000
+
+@reintentar_http
+def _post_derivador(payload: dict):
+    resp = http_request("POST", DERIVADOR_SERVICE_URL, 5, json=payload)
+    resp.raise_for_status()
+
+def _encolar_derivacion(payload: dict):
+    pipe = redis_client.pipeline()
+    pipe.rpush(DERIVADOR_PENDIENTES, json.dumps(payload))
+    pipe.ltrim(DERIVADOR_PENDIENTES, -DERIVADOR_PENDIENTES_MAX, -1)
+    pipe.execute()
+    metrica_inc("alia_derivaciones_diferidas_total")
+
+def reenviar_derivaciones_pendientes():
+    while not circuito_derivador.abierto():
+        raw = redis_client.lpop(DERIVADOR_PENDIENTES)
+        if raw is None:
+            return
+        try:
+            circuito_derivador.llamar(_post_derivador, json.loads(raw))
+            logger.info("Caso pendiente derivado a operador")
+        except (RequestException, CircuitoAbierto) as e:
+            if isinstance(e, RequestException) and not es_error_http_reintentable(e):
+                logger.error(f"Derivación pendiente rechazada, se descarta: {e}")
+                continue
+            redis_client.lpush(DERIVADOR_PENDIENTES, raw)
+            return
+
+circuito_derivador = CircuitBreaker(
+    "derivador", es_error_http_reintentable, lambda: _sonda_http(DERIVADOR_SERVICE_URL),
+    reenviar_derivaciones_pendientes
+)
+
 def derivar_a_operador(payload: dict):
+    # El operador recibe la foto de la orden si la sesión la tiene (orden no
+    # leída por OCR caído, o turno que no se pudo registrar)
+    imagen = redis_client.get(_key_imagen_paciente(payload["from_number"]))
+    if imagen:
+        payload = {**payload, "imagen_orden": imagen}
     try:
-        resp = requests.post(DERIVADOR_SERVICE_URL, json=payload, timeout=5)
-        resp.raise_for_status()
+        circuito_derivador.llamar(_post_derivador, payload)
         logger.info("Caso derivado a operador")
-    except RequestException as e:
-        logger.error(f"Error derivando a operador: {e}")
+    except (RequestException, CircuitoAbierto) as e:
+        logger.error(f"Error derivando a operador, el caso queda pendiente: {e}")
+        _encolar_derivacion(payload)
+        return
+    if redis_client.llen(DERIVADOR_PENDIENTES):
+        threading.Thread(target=reenviar_derivaciones_pendientes, name="derivador-pendientes", daemon=True).start()
+
+@registrar_colector
+def _colector_derivaciones_pendientes():
+    metrica_set("alia_derivaciones_pendientes", redis_client.llen(DERIVADOR_PENDIENTES))
 
 # --- Procesamiento de imágenes -----------------------------------------------
 def compress_image(img_bytes: bytes) -> bytes:
+    # Reduce sin deformar: draft() hace que el decoder JPEG escale en la DCT,
+    # thumbnail() preserva la relación de aspecto y exif_transpose endereza
+    # las fotos de celular. Un JPEG que ya es chico y derecho pasa tal cual.
     try:
         img = Image.open(io.BytesIO(img_bytes))
-        img = img.resize((1024,1024), Image.Resampling.LANCZOS)
+        orientacion = img.getexif().get(0x0112, 1)
+        if (img.format == "JPEG" and len(img_bytes) <= IMAGEN_BYTES_OK
+                and max(img.size) <= IMAGEN_LADO_MAX and orientacion == 1):
+            metrica_inc("alia_imagenes_total", resultado="sin_recomprimir")
+            return img_bytes
+        img.draft("RGB", (IMAGEN_LADO_MAX, IMAGEN_LADO_MAX))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((IMAGEN_LADO_MAX, IMAGEN_LADO_MAX), Image.Resampling.LANCZOS)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
         buf = io.BytesIO()
-        img.save(buf, format="JPEG", quality=85)
+        img.save(buf, format="JPEG", quality=85, optimize=True)
+        metrica_inc("alia_imagenes_total", resultado="recomprimida")
         return buf.getvalue()
     except Exception as e:
         logger.error(f"Error comprimiendo imagen: {e}")
         return img_bytes
 
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
+def hash_imagen(img_bytes: bytes) -> str:
+    return hashlib.sha256(img_bytes).hexdigest()
+
+@reintentar_http
+@medir("ocr")
 def call_ocr_service(image_b64: str) -> dict:
-    resp = requests.post(OCR_SERVICE_URL, json={"image_base64": image_b64}, timeout=10)
+    resp = http_request("POST", OCR_SERVICE_URL, 10, json={"image_base64": image_b64})
     resp.raise_for_status()
     return resp.json()
 
+circuito_ocr = CircuitBreaker("ocr", es_error_http_reintentable, lambda: _sonda_http(OCR_SERVICE_URL))
+
+# --- Gateway de OpenAI --------------------------------------------------------
+# Todas las llamadas a OpenAI pasan por acá: sesión HTTP con keep-alive,
+# deadline por llamada, semáforo de concurrencia y coalescencia de prompts
+# idénticos en vuelo (solo el primero llega a OpenAI, el resto espera).
+class SingleFlight:
+    def __init__(self):
+        self._lock     = threading.Lock()
+        self._en_vuelo = {}
+
+    def hacer(self, key: str, fn):
+        with self._lock:
+            llamada = self._en_vuelo.get(key)
+            lider = llamada is None
+            if lider:
+                llamada = self._en_vuelo[key] = {"listo": threading.Event(), "res": None, "err": None}
+        if not lider:
+            llamada["listo"].wait()
+            if llamada["err"] is not None:
+                raise llamada["err"]
+            return llamada["res"]
+        try:
+            llamada["res"] = fn()
+            return llamada["res"]
+        except Exception as e:
+            llamada["err"] = e
+            raise
+        finally:
+            with self._lock:
+                self._en_vuelo.pop(key, None)
+            llamada["listo"].set()
+
+_llm_semaforo = threading.BoundedSemaphore(OPENAI_CONCURRENCIA)
+_llm_vuelos   = SingleFlight()
+
+def _es_fallo_openai(e: Exception) -> bool:
+    # La saturación local (_llm_adquirir) queda fuera del breaker
+    error = cliente_openai().error
+    return isinstance(e, (error.Timeout, error.APIConnectionError, error.APIError,
+                          error.RateLimitError, error.ServiceUnavailableError, error.TryAgain))
+
+def _sonda_openai():
+    openai = cliente_openai()
+    _sonda_http(f"{openai.api_base}/models", headers={"Authorization": f"Bearer {openai.api_key}"})
+
+circuito_openai = CircuitBreaker("openai", _es_fallo_openai, _sonda_openai)
+
+def _llm_adquirir(timeout: float) -> float:
+    inicio = time.time()
+    if not _llm_semaforo.acquire(timeout=timeout):
+        metrica_inc("alia_llm_llamadas_total", resultado="saturado")
+        raise cliente_openai().error.Timeout("Sin capacidad disponible para llamar a OpenAI")
+    return max(1.0, timeout - (time.time() - inicio))
+
+def _llm_llamar(messages: list, temperature: float, timeout: float) -> str:
+    circuito_openai.verificar()
+    restante = _llm_adquirir(timeout)
+    try:
+        with medir("openai"):
+            resp = circuito_openai.llamar(
+                cliente_openai().ChatCompletion.create,
+                model=OPENAI_MODEL,
+                messages=messages,
+                temperature=temperature,
+                request_timeout=restante
+            )
+        metrica_inc("alia_llm_llamadas_total", resultado="ok")
+        return resp.choices[0].message.content.strip()
+    except Exception:
+        metrica_inc("alia_llm_llamadas_total", resultado="error")
+        raise
+    finally:
+        _llm_semaforo.release()
+
+def llm_completar(prompt: str, temperature: float = 0.0, timeout: float = None) -> str:
+    messages = [{"role":"user","content":prompt}]
+    key = hashlib.sha256(json.dumps([OPENAI_MODEL, messages, temperature]).encode()).hexdigest()
+    lider = []
+    def llamar():
+        lider.append(True)
+        return _llm_llamar(messages, temperature, timeout or OPENAI_TIMEOUT)
+    resultado = _llm_vuelos.hacer(key, llamar)
+    if not lider:
+        metrica_inc("alia_llm_coalescidas_total")
+    return resultado
+
+def llm_stream(prompt: str, temperature: float = 0.0, timeout: float = None):
+    circuito_openai.verificar()
+    restante = _llm_adquirir(timeout or OPENAI_TIMEOUT)
+    inicio, resultado = time.time(), "error"
+    try:
+        chunks = cliente_openai().ChatCompletion.create(
+            model=OPENAI_MODEL,
+            messages=[{"role":"user","content":prompt}],
+            temperature=temperature,
+            request_timeout=restante,
+            stream=True
+        )
+        for chunk in chunks:
+            delta = chunk.choices[0].delta.get("content")
+            if delta:
+                yield delta
+        resultado = "ok"
+        circuito_openai.registrar()
+        metrica_inc("alia_llm_llamadas_total", resultado="ok")
+    except Exception as e:
+        circuito_openai.registrar(e)
+        metrica_inc("alia_llm_llamadas_total", resultado="error")
+        raise
+    finally:
+        _llm_semaforo.release()
+        registrar_etapa("openai", time.time() - inicio, resultado)
+
+# --- Salida parcial hacia el canal del mensaje -----------------------------
+# Quien procesa un mensaje puede registrar un emisor (p. ej. el /chat con
+# stream) para recibir tokens y estados intermedios; WhatsApp no lo usa.
+def emitir_parcial(tipo: str, texto: str):
+    emisor = getattr(_contexto, "emisor", None)
+    if emisor is not None:
+        emisor(tipo, texto)
+
+def hay_emisor() -> bool:
+    return getattr(_contexto, "emisor", None) is not None
+
+# --- Reglas locales de preparación de estudios -----------------------------
+# Traducción directa de las reglas del prompt de instrucciones: si todos los
+# estudios se reconocen acá no hace falta llamar a GPT-4. Cada regla es
+# (palabras clave, ayuno en horas o None, recolección de orina o None).
+INSTRUCCIONES_PROMPT_VERSION = "v1"
+
+ORINA_24H     = "orina de 24 horas"
+ORINA_PRIMERA = "primera orina de la mañana"
+
+REGLAS_ESTUDIOS = [
+    (("pirens",), 8, None),
+    (("colesterol", "trigliceridos", "hdl", "ldl", "vldl", "lipidograma", "perfil lipidico",
+      "lipoproteina", "apolipoproteina"), 12, None),
+    (("hepatograma", "perfil hepatico", "tgo", "tgp", "got", "gpt", "bilirrubina",
+      "fosfatasa alcalina", "gamma gt", "ggt"), 12, None),
+    (("perfil hormonal", "tsh", "t3", "t4", "t4 libre", "cortisol", "insulina", "prolactina",
+      "lh", "fsh", "estradiol", "progesterona", "testosterona", "pth"), 12, None),
+    (("hemograma", "glucemia", "glucosa", "urea", "creatinina", "acido urico", "ionograma",
+      "eritrosedimentacion", "vsg", "hemoglobina glicosilada", "hba1c", "ferritina", "hierro",
+      "vitamina d", "vitamina b12", "psa", "coagulograma", "kptt", "tiempo de protrombina",
+      "grupo sanguineo", "factor rh", "vdrl", "hiv", "calcio", "magnesio", "fosforo"), 8, None),
+    (("microalbuminuria espontanea",), None, ORINA_PRIMERA),
+    (("microalbuminuria", "clearance", "proteinuria de 24", "orina de 24"), None, ORINA_24H),
+    (("primera orina", "sedimento urinario", "orina completa"), None, ORINA_PRIMERA),
+]
+
+_REGLAS_COMPILADAS = [
+    (re.compile(r"\b(" + "|".join(re.escape(k) for k in claves) + r")\b"), ayuno, orina)
+    for claves, ayuno, orina in REGLAS_ESTUDIOS
+]
+
+def normalizar_estudios(estudios_list: list) -> list:
+    return sorted({normalizar_texto(e) for e in estudios_list or [] if normalizar_texto(e)})
+
+def clave_instrucciones(estudios_list: list) -> str:
+    contenido = INSTRUCCIONES_PROMPT_VERSION + "|" + "\n".join(normalizar_estudios(estudios_list))
+    return f"instrucciones:{hashlib.sha256(contenido.encode()).hexdigest()}"
+
+def clasificar_estudio(nombre: str) -> tuple:
+    # Primero el catálogo; si el estudio no está, las reglas por palabra
+    # clave. Dentro de sangre y de orina gana la primera regla que coincide
+    # (por eso pirens y "espontánea" van antes); un clearance suma ayuno y orina.
+    canonico = catalogo_estudios.buscar(nombre)[0]
+    if canonico is not None:
+        return catalogo_estudios.preparacion(canonico)
+    ayuno = orina = None
+    for patron, regla_ayuno, regla_orina in _REGLAS_COMPILADAS:
+        if not patron.search(nombre):
+            continue
+        if regla_ayuno and ayuno is None:
+            ayuno = regla_ayuno
+        if regla_orina and orina is None:
+            orina = regla_orina
+    if ayuno is None and orina is None:
+        return None
+    return ayuno, orina
+
+def instrucciones_locales(estudios_list: list) -> str:
+    estudios = normalizar_estudios(estudios_list)
+    if not estudios:
+        return None
+    ayunos, orinas = [], []
+    for estudio in estudios:
+        regla = clasificar_estudio(estudio)
+        if regla is None:
+            return None
+        ayuno, orina = regla
+        if ayuno:
+            ayunos.append(ayuno)
+        if orina and orina not in orinas:
+            orinas.append(orina)
+    return texto_instrucciones(ayunos, orinas)
+
+def texto_instrucciones(ayunos: list, orinas: list) -> str:
+    ayuno_txt = f"Ayuno de {max(ayunos)} horas" if ayunos else "No requiere ayuno"
+    orina_txt = "Recolectar " + " y ".join(sorted(orinas)) if orinas else "No requiere recolección de orina"
+    return f"Ayuno de sangre: {ayuno_txt}.\nRecolección de orina: {orina_txt}."
+
+def parsear_instrucciones(texto: str) -> tuple:
+    # Lee la salida del prompt de instrucciones: (horas de ayuno o None, orinas)
+    lineas = [normalizar_texto(l) for l in (texto or "").splitlines()]
+    if not any("ayuno" in l or "orina" in l for l in lineas):
+        raise ValueError(f"Instrucciones sin formato reconocible: {texto[:200]!r}")
+    horas = [int(h) for l in lineas for h in re.findall(r"ayuno de (\d+) horas", l)]
+    orinas = []
+    for l in lineas:
+        if "recolectar" not in l:
+            continue
+        if "24 horas" in l and ORINA_24H not in orinas:
+            orinas.append(ORINA_24H)
+        if "primera orina" in l and ORINA_PRIMERA not in orinas:
+            orinas.append(ORINA_PRIMERA)
+    return (max(horas) if horas else None), orinas
+
+# --- Catálogo de estudios ----------------------------------------------------
+# Nombres canónicos, sinónimos y preparación de cada estudio, leídos una vez
+# de ESTUDIOS_CATALOGO e indexados en memoria. La búsqueda es exacta sobre el
+# nombre limpio (sin tildes, signos ni palabras de relleno como "dosaje de")
+# y, si no hay, por similitud de trigramas para errores de tipeo
+# ("hemogrma"). Las abreviaturas de hasta 3 letras solo valen exactas y los
+# números tienen que coincidir (T3 no es T4, B12 no es D). El parecido solo
+# corrige errores dentro de una palabra: el candidato tiene que tener las
+# mismas palabras, cada una a una o dos letras de distancia ("acido folico"
+# no es "acido urico", "hemoglobina" no es "hemoglobina glicosilada").
+_RELLENO_ESTUDIOS = {
+    "de", "del", "en", "la", "el", "dosaje", "determinacion", "nivel", "niveles",
+    "valor", "sangre", "suero", "serico", "serica", "plasmatico", "plasmatica", "total"
+}
+ORINA_CATALOGO = {"24h": ORINA_24H, "primera": ORINA_PRIMERA}
+
+def limpiar_estudio(nombre: str) -> str:
+    palabras = re.sub(r"[^a-z0-9]+", " ", normalizar_texto(nombre)).split()
+    utiles = [p for p in palabras if p not in _RELLENO_ESTUDIOS]
+    return " ".join(utiles or palabras)
+
+def _trigramas(texto: str) -> set:
+    t = f"  {texto} "
+    return {t[i:i + 3] for i in range(len(t) - 2)}
+
+def _distancia_edicion(a: str, b: str) -> int:
+    # Levenshtein con transposición de letras vecinas ("hemgoloblina")
+    previa, fila = None, list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        anterior, previa, fila = previa, fila, [i] + [0] * len(b)
+        for j, cb in enumerate(b, 1):
+            fila[j] = min(previa[j] + 1, fila[j - 1] + 1, previa[j - 1] + (ca != cb))
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                fila[j] = min(fila[j], anterior[j - 2] + 1)
+    return fila[-1]
+
+def _palabras_coinciden(palabras: list, otras: list) -> bool:
+    if len(palabras) != len(otras):
+        return False
+    return all(_distancia_edicion(p, o) <= (1 if len(o) <= 6 else 2) for p, o in zip(palabras, otras))
+
+def separar_estudios(texto: str) -> list:
+    return [e.strip() for e in re.split(r"[,;\n+]", texto or "") if e.strip()]
+
+class CatalogoEstudios:
+    def __init__(self, config: dict):
+        self.umbral = float(config.get("umbral_difuso", 0.6))
+        self.estudios = {}                  # canónico -> (ayuno, orina)
+        self._exactos = {}                  # forma limpia -> canónico
+        self._formas = {}                   # forma limpia -> (trigramas, números, palabras)
+        self._indice = defaultdict(set)     # trigrama -> formas
+        for e in config["estudios"]:
+            nombre = e["nombre"]
+            self.estudios[nombre] = (e.get("ayuno"), ORINA_CATALOGO.get(e.get("orina")))
+            for forma in {limpiar_estudio(nombre), *(limpiar_estudio(s) for s in e.get("sinonimos", []))}:
+                self._exactos.setdefault(forma, nombre)
+                if len(forma) <= 3:
+                    continue
+                tri = _trigramas(forma)
+                self._formas[forma] = (tri, re.findall(r"\d+", forma), forma.split())
+                for t in tri:
+                    self._indice[t].add(forma)
+
+    def buscar(self, nombre: str) -> tuple:
+        # (canónico o None, "exacto" | "difuso" | "desconocido")
+        limpio = limpiar_estudio(nombre)
+        canonico = self._exactos.get(limpio)
+        if canonico is not None:
+            return canonico, "exacto"
+        if len(limpio) <= 3:
+            return None, "desconocido"
+        tri, numeros, palabras = _trigramas(limpio), re.findall(r"\d+", limpio), limpio.split()
+        comunes = defaultdict(int)
+        for t in tri:
+            for forma in self._indice.get(t, ()):
+                comunes[forma] += 1
+        mejor, puntaje = None, 0.0
+        for forma, n in comunes.items():
+            tri_forma, numeros_forma, palabras_forma = self._formas[forma]
+            dice = 2 * n / (len(tri) + len(tri_forma))
+            if dice > puntaje and numeros_forma == numeros and _palabras_coinciden(palabras, palabras_forma):
+                mejor, puntaje = forma, dice
+        if mejor is not None and puntaje >= self.umbral:
+            return self._exactos[mejor], "difuso"
+        return None, "desconocido"
+
+    def preparacion(self, canonico: str) -> tuple:
+        return self.estudios[canonico]
+
+    def canonicalizar(self, nombres: list) -> tuple:
+        # Devuelve (estudios, desconocidos): los reconocidos con su nombre
+        # canónico y sin repetir; los desconocidos tal como llegaron.
+        estudios, desconocidos = [], []
+        for nombre in nombres or []:
+            nombre = str(nombre).strip()
+            if not nombre:
+                continue
+            canonico, resultado = self.buscar(nombre)
+            metrica_inc("alia_estudios_total", resultado=resultado)
+            if canonico is None:
+                desconocidos.append(nombre)
+                canonico = nombre
+            if canonico not in estudios:
+                estudios.append(canonico)
+        return estudios, desconocidos
+
+def cargar_catalogo_estudios(path: str) -> CatalogoEstudios:
+    with open(path, encoding="utf-8") as f:
+        return CatalogoEstudios(json.load(f))
+
+catalogo_estudios = cargar_catalogo_estudios(ESTUDIOS_CATALOGO)
+
+# --- Intenciones de la consulta libre ----------------------------------------
+# Antes de ir a OpenAI, el texto libre se compara (TF-IDF, coseno) contra los
+# ejemplos de INTENCIONES_CONFIG más "sede X" por cada sede del calendario.
+# Si el ejemplo más parecido supera el umbral la respuesta sale de acá;
+# las palabras que no están en ningún ejemplo pesan como las más raras, así
+# que una pregunta larga con una sola palabra conocida no pasa el umbral.
+# Las palabras se recortan a 5 letras ("horarios" y "horario" coinciden).
+_PALABRAS_VACIAS = {
+    "a", "al", "de", "del", "el", "la", "los", "las", "lo", "en", "y", "o", "u", "que", "por",
+    "para", "con", "un", "una", "me", "mi", "mis", "se", "es", "su", "sus", "le", "les", "te", "tu"
+}
+DIAS_SEMANA = ["lunes", "martes", "miércoles", "jueves", "viernes", "sábado", "domingo"]
+
+def limpiar_consulta(texto: str) -> str:
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", normalizar_texto(texto)).split())
+
+def tokens_intencion(texto: str) -> list:
+    return [p[:5] for p in limpiar_consulta(texto).split() if p not in _PALABRAS_VACIAS]
+
+class ClasificadorIntenciones:
+    def __init__(self, config: dict, sedes: list):
+        self.umbral = float(config.get("umbral", 0.55))
+        self.horarios = config.get("horarios", {})
+        self.respuestas = {}                # intención -> texto fijo
+        self.patrones = []                  # (regex, intención), se prueban primero
+        ejemplos = []                       # (intención, tokens)
+        formato = {f"horario_{k}": v for k, v in self.horarios.items()}
+        for nombre, intencion in config["intenciones"].items():
+            if "respuesta" in intencion:
+                self.respuestas[nombre] = intencion["respuesta"].format(**formato)
+            if "patron" in intencion:
+                self.patrones.append((re.compile(intencion["patron"]), nombre))
+            ejemplos += [(nombre, tokens_intencion(e)) for e in intencion.get("ejemplos", [])]
+        ejemplos += [("sedes", tokens_intencion(f"sede {sede}")) for sede, _, _ in sedes if sede != "GENERAL"]
+
+        df = defaultdict(int)
+        for _, tokens in ejemplos:
+            for t in set(tokens):
+                df[t] += 1
+        self.idf = {t: math.log((1 + len(ejemplos)) / (1 + n)) + 1 for t, n in df.items()}
+        self.idf_desconocido = math.log(1 + len(ejemplos)) + 1
+        self._intencion = []                # intención de cada ejemplo
+        self._indice = defaultdict(list)    # token -> [(ejemplo, peso)]
+        for i, (nombre, tokens) in enumerate(ejemplos):
+            self._intencion.append(nombre)
+            for t, peso in self._vector(tokens).items():
+                self._indice[t].append((i, peso))
+
+    def _vector(self, tokens: list) -> dict:
+        tf = defaultdict(int)
+        for t in tokens:
+            tf[t] += 1
+        vector = {t: n * self.idf.get(t, self.idf_desconocido) for t, n in tf.items()}
+        norma = math.sqrt(sum(p * p for p in vector.values()))
+        return {t: p / norma for t, p in vector.items()} if norma else {}
+
+    def clasificar(self, texto: str) -> tuple:
+        # (intención más parecida o None, puntaje entre 0 y 1)
+        limpio = limpiar_consulta(texto)
+        for patron, nombre in self.patrones:
+            if patron.match(limpio):
+                return nombre, 1.0
+        puntajes = defaultdict(float)
+        for t, peso in self._vector(tokens_intencion(limpio)).items():
+            for i, peso_ejemplo in self._indice.get(t, ()):
+                puntajes[i] += peso * peso_ejemplo
+        if not puntajes:
+            return None, 0.0
+        mejor = max(puntajes, key=puntajes.get)
+        return self._intencion[mejor], min(1.0, puntajes[mejor])
+
+def cargar_clasificador_intenciones(path: str) -> ClasificadorIntenciones:
+    with open(path, encoding="utf-8") as f:
+        return ClasificadorIntenciones(json.load(f), calendario.sedes)
+
+clasificador_intenciones = cargar_clasificador_intenciones(INTENCIONES_CONFIG)
+
+def _enumerar(items: list) -> str:
+    return items[0] if len(items) == 1 else f"{', '.join(items[:-1])} y {items[-1]}"
+
+def respuesta_sedes(content: str) -> str:
+    txt = limpiar_consulta(content)
+    horario = clasificador_intenciones.horarios.get("sedes", "")
+    sedes = [(n, d, l) for n, d, l in calendario.sedes if n != "GENERAL"]
+    for nombre, direccion, localidades in sedes:
+        if normalizar_texto(nombre) in txt or any(l in txt for l in localidades):
+            return f"La sede {nombre.title()} está en {direccion}. Atendemos {horario}."
+    lista = "\n".join(f"- {nombre.title()}: {direccion}" for nombre, direccion, _ in sedes)
+    return f"Nuestras sedes:\n{lista}\nAtendemos {horario}. Para pedir un turno escribe 'hola'."
+
+def respuesta_domicilio(content: str) -> str:
+    txt = limpiar_consulta(content)
+    horario = clasificador_intenciones.horarios.get("domicilio", "")
+    for _, localidades, dias in calendario.zonas:
+        localidad = next((l for l in localidades if l in txt), None)
+        if localidad is not None:
+            return (
+                f"En {localidad.title()} hacemos extracciones a domicilio los "
+                f"{_enumerar([DIAS_SEMANA[d] for d in sorted(dias)])} {horario}.\n"
+                "Para pedir un turno escribe 'hola' y elige la opción 1."
+            )
+    return (
+        f"Sí, hacemos extracciones a domicilio {horario}; el día depende de tu localidad.\n"
+        "Para pedir un turno escribe 'hola' y elige la opción 1."
+    )
+
+def clave_consulta(content: str) -> str:
+    contenido = f"{OPENAI_MODEL}|{limpiar_consulta(content)}"
+    return f"consulta:{hashlib.sha256(contenido.encode()).hexdigest()}"
+
 # --- Lógica de OpenAI --------------------------------------------------------
 def get_instrucciones_estudios(estudios_list: list) -> str:
-    cache_key = f"instrucciones:{hash(','.join(sorted(estudios_list)))}"
+    # Los estudios reconocidos (catálogo o reglas) se resuelven localmente;
+    # a GPT-4 solo van los desconocidos y su respuesta se combina con la local.
+    estudios = normalizar_estudios(estudios_list)
+    reglas = {e: clasificar_estudio(e) for e in estudios}
+    desconocidos = [e for e, regla in reglas.items() if regla is None]
+    if estudios and not desconocidos:
+        metrica_inc("alia_instrucciones_total", nivel="reglas")
+        return instrucciones_locales(estudios)
+    instrucciones = _instrucciones_llm(desconocidos or estudios_list)
+    conocidos = [regla for regla in reglas.values() if regla is not None]
+    if instrucciones is None:
+        return instrucciones_parciales(conocidos, desconocidos)
+    if not conocidos:
+        return instrucciones
+    try:
+        ayuno_llm, orinas = parsear_instrucciones(instrucciones)
+    except ValueError as e:
+        logger.warning(f"{e}; se piden las instrucciones de la lista completa")
+        return _instrucciones_llm(estudios) or "No pude obtener indicaciones específicas. Por favor, consulta al laboratorio."
+    ayunos = [a for a, _ in conocidos if a] + ([ayuno_llm] if ayuno_llm else [])
+    for _, orina in conocidos:
+        if orina and orina not in orinas:
+            orinas.append(orina)
+    return texto_instrucciones(ayunos, orinas)
+
+def instrucciones_parciales(conocidos: list, desconocidos: list) -> str:
+    # Sin OpenAI: lo que se sabe por reglas y el resto queda para el laboratorio
+    if not conocidos:
+        return "No pude obtener indicaciones específicas. Por favor, consulta al laboratorio."
+    ayunos = [a for a, _ in conocidos if a]
+    orinas = []
+    for _, orina in conocidos:
+        if orina and orina not in orinas:
+            orinas.append(orina)
+    return (
+        f"{texto_instrucciones(ayunos, orinas)}\n"
+        f"Para {', '.join(desconocidos)} consulta las indicaciones con el laboratorio."
+    )
+
+def _instrucciones_llm(estudios_list: list) -> str:
+    cache_key = clave_instrucciones(estudios_list)
     cached = redis_client.get(cache_key)
     if cached:
+        metrica_inc("alia_instrucciones_total", nivel="cache")
         return cached
 
+    emitir_parcial("estado", "Preparando las indicaciones para tus estudios…")
     prompt = f"""
 Estos son los estudios solicitados: {', '.join(estudios_list)}.
 Eres un asistente de laboratorio especializado en indicar ayuno y recolección de orina. Tu tarea:
@@ -366,17 +2538,92 @@ Eres un asistente de laboratorio especializado en indicar ayuno y recolección d
    - Recolección de orina: “Recolectar Y” o “No requiere recolección de orina”.
 """
     try:
-        resp = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[{"role":"user","content":prompt}],
-            temperature=0.0
-        )
-        instrucciones = resp.choices[0].message.content.strip()
+        instrucciones = llm_completar(prompt)
         redis_client.set(cache_key, instrucciones, ex=86400)
+        metrica_inc("alia_instrucciones_total", nivel="llm")
         return instrucciones
-    except openai.OpenAIError as e:
+    except (cliente_openai().OpenAIError, CircuitoAbierto) as e:
         logger.error(f"Error OpenAI: {e}")
-        return "No pude obtener indicaciones específicas. Por favor, consulta al laboratorio."
+        metrica_inc("alia_instrucciones_total", nivel="error")
+        return None
+
+# --- Cache de OCR por contenido de imagen ----------------------------------
+# La misma orden reenviada (o fotografiada de nuevo sin cambios) da la misma
+# imagen comprimida: se guarda el texto OCR y el JSON parseado bajo su sha256.
+# La expiración es deslizante y un índice ordenado por último acceso mantiene
+# el cache en OCR_CACHE_MAX entradas (LRU). Pedidos concurrentes del mismo
+# hash esperan a un único líder, en el proceso y entre procesos (lock Redis).
+OCR_INDICE = "ocr:indice"
+
+_ocr_vuelos = SingleFlight()
+
+def _ocr_cacheado(h: str) -> dict:
+    cached = redis_client.get(f"ocr:{h}")
+    if cached is None:
+        return None
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.expire(f"ocr:{h}", OCR_CACHE_TTL)
+    pipe.zadd(OCR_INDICE, {h: time.time()})
+    pipe.execute()
+    return json.loads(cached)
+
+def _guardar_ocr(h: str, resultado: dict):
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.set(f"ocr:{h}", json.dumps(resultado), ex=OCR_CACHE_TTL)
+    pipe.zadd(OCR_INDICE, {h: time.time()})
+    pipe.zcard(OCR_INDICE)
+    exceso = pipe.execute()[-1] - OCR_CACHE_MAX
+    if exceso > 0:
+        viejos = redis_client.zrange(OCR_INDICE, 0, exceso - 1)
+        if viejos:
+            redis_client.delete(*[f"ocr:{v}" for v in viejos])
+            redis_client.zrem(OCR_INDICE, *viejos)
+            metrica_inc("alia_ocr_cache_desalojos_total", len(viejos))
+
+def _ocr_y_parseo(compressed: bytes) -> dict:
+    ocr_data = circuito_ocr.llamar(call_ocr_service, base64.b64encode(compressed).decode())
+    texto_ocr = ocr_data.get("text","").strip()
+    if not texto_ocr:
+        return {"texto": "", "datos": {}}
+    prompt = (
+        f"Analiza esta orden médica y devuelve un JSON con las claves:\n"
+        f"estudios, cobertura, afiliado.\n\n{texto_ocr}"
+    )
+    return {"texto": texto_ocr, "datos": json.loads(llm_completar(prompt))}
+
+def _analizar_orden_lider(h: str, compressed: bytes) -> dict:
+    lock, token = f"ocr:lock:{h}", uuid.uuid4().hex
+    limite = time.time() + 60
+    while not redis_client.set(lock, token, nx=True, ex=60):
+        # Otro proceso está analizando la misma imagen
+        if time.time() > limite:
+            break
+        time.sleep(0.25)
+        cached = _ocr_cacheado(h)
+        if cached is not None:
+            metrica_inc("alia_ocr_cache_total", resultado="espera")
+            return cached
+    try:
+        cached = _ocr_cacheado(h)
+        if cached is not None:
+            metrica_inc("alia_ocr_cache_total", resultado="hit")
+            return cached
+        metrica_inc("alia_ocr_cache_total", resultado="miss")
+        resultado = _ocr_y_parseo(compressed)
+        if resultado["texto"]:
+            _guardar_ocr(h, resultado)
+        return resultado
+    finally:
+        liberar_lease(lock, token)
+
+def analizar_orden(compressed: bytes) -> dict:
+    h = hash_imagen(compressed)
+    cached = _ocr_cacheado(h)
+    if cached is not None:
+        metrica_inc("alia_ocr_cache_total", resultado="hit")
+        return cached
+    emitir_parcial("estado", "Analizando tu orden médica…")
+    return _ocr_vuelos.hacer(h, lambda: _analizar_orden_lider(h, compressed))
 
 # --- Lógica central de ALIA --------------------------------------------------
 def handle_esperando_orden(from_number: str, content: str, paciente: dict) -> str:
@@ -386,11 +2633,33 @@ def handle_esperando_orden(from_number: str, content: str, paciente: dict) -> st
         return "Ok, continuamos sin orden médica.\nPor favor, escribe los estudios solicitados:"
     return "Por favor envía la foto de tu orden médica o responde 'no' para continuar sin orden."
 
+def _aviso_desconocidos(desconocidos: list) -> str:
+    if not desconocidos:
+        return ""
+    return f"\n(No reconocimos: {', '.join(desconocidos)}; el laboratorio los va a revisar.)"
+
 def handle_estudios_manual(from_number: str, content: str, paciente: dict) -> str:
-    paciente["estudios"] = [e.strip() for e in content.split(",")]
+    estudios, desconocidos = catalogo_estudios.canonicalizar(separar_estudios(content))
+    if not estudios:
+        return "No encontramos estudios en tu mensaje. Escríbelos separados por comas."
+    paciente["estudios"] = estudios
     paciente["estado"] = BotState.ESPERANDO_ESTUDIOS_CONFIRMACION.value
     save_paciente(from_number, paciente)
-    return f"Hemos recibido estos estudios: {', '.join(paciente['estudios'])}.\n¿Los confirmas? (sí/no)"
+    return (
+        f"Hemos recibido estos estudios: {', '.join(estudios)}.{_aviso_desconocidos(desconocidos)}\n"
+        "¿Los confirmas? (sí/no)"
+    )
+
+def turno_no_registrado(from_number: str, paciente: dict, instrucciones: str) -> str:
+    # No se pudo guardar ni en Sheets ni en el buffer: no se confirma el
+    # turno y el caso pasa a un operador con los datos ya cargados
+    metrica_inc("alia_turnos_no_registrados_total", tipo=paciente.get("tipo_atencion") or "")
+    derivar_a_operador({"from_number": from_number, "paciente": paciente, "motivo": "turno_no_registrado"})
+    clear_paciente(from_number)
+    return (
+        f"{instrucciones}\n\nNo pudimos registrar tu turno en este momento. "
+        "Un operador te contactará para confirmarlo."
+    )
 
 def handle_estudios_confirmacion(from_number: str, content: str, paciente: dict) -> str:
     if content.strip().lower() in ("sí","si","s"):
@@ -399,7 +2668,8 @@ def handle_estudios_confirmacion(from_number: str, content: str, paciente: dict)
         if tipo == "SEDE":
             sede, dir_sede = determinar_sede(localidad)
             date, dia = determinar_dia_turno(localidad)
-            registrar_turno(paciente, date, "Sedes", sede)
+            if not registrar_turno(paciente, date, "Sedes", sede):
+                return turno_no_registrado(from_number, paciente, instrucciones)
             final = (
                 f"El pre-ingreso se realizó correctamente.\n"
                 f"Te esperamos en la sede {sede} ({dir_sede}) el {dia} ({date.strftime('%d/%m/%Y')}) de 07:40 a 11:00.\n"
@@ -407,9 +2677,18 @@ def handle_estudios_confirmacion(from_number: str, content: str, paciente: dict)
             )
         else:
             date, dia = determinar_dia_turno(localidad)
-            while count_domicilio_patients(date) >= 15:
+            for _ in range(CUPOS_DIAS_MAX):
+                if reservar_cupo_domicilio(date, localidad):
+                    break
                 date, dia = get_next_business_day(date, localidad)
-            registrar_turno(paciente, date, "Domicilios")
+            else:
+                logger.error(f"Sin cupos de domicilio para {localidad} en {CUPOS_DIAS_MAX} días")
+                derivar_a_operador({"from_number": from_number, "paciente": paciente})
+                clear_paciente(from_number)
+                return f"{instrucciones}\n\nNo hay cupos de domicilio disponibles por ahora. Un operador te contactará para coordinar la visita."
+            if not registrar_turno(paciente, date, "Domicilios"):
+                liberar_cupo_domicilio(date, localidad)
+                return turno_no_registrado(from_number, paciente, instrucciones)
             final = (
                 f"Tu turno se reservó para el día {dia} ({date.strftime('%d/%m/%Y')}), te visitaremos de 08:00 a 11:00.\n"
                 "Las prácticas quedan sujetas a autorización del prestador."
@@ -445,15 +2724,14 @@ def handle_menu_turno(from_number: str, content: str, paciente: dict) -> str:
     else:
         return "Por favor elige 1 o 2."
     pregunta = siguiente_campo_faltante(paciente)
+    if pregunta is None:
+        paciente["estado"] = BotState.ESPERANDO_ORDEN.value
+        pregunta = "Envía foto de tu orden médica o responde 'no' para continuar sin orden."
     save_paciente(from_number, paciente)
     return pregunta
 
 def handle_datos_secuenciales(from_number: str, content: str, paciente: dict) -> str:
-    campo = paciente["estado"].split("_",1)[1]
-    if campo == "fecha_nacimiento" and not validate_fecha_nacimiento(content):
-        return "Formato de fecha inválido (dd/mm/aaaa). Intenta de nuevo:"
-    if campo == "afiliado" and not validate_afiliado(content):
-        return "Número de afiliado inválido. Usa solo letras y números:"
+    campo = CAMPO_POR_ESTADO[BotState(paciente["estado"])]
     paciente[campo] = content.title() if campo in ["nombre","localidad"] else content
     siguiente = siguiente_campo_faltante(paciente)
     save_paciente(from_number, paciente)
@@ -464,7 +2742,7 @@ def handle_datos_secuenciales(from_number: str, content: str, paciente: dict) ->
     return "Envía foto de tu orden médica o responde 'no' para continuar sin orden."
 
 def handle_resultados(from_number: str, content: str, paciente: dict) -> str:
-    campo = paciente["estado"].split("_",1)[1]
+    campo = CAMPO_POR_ESTADO[BotState(paciente["estado"])]
     if campo == "nombre":
         paciente["nombre"] = content.title()
         paciente["estado"] = BotState.ESPERANDO_RESULTADOS_DNI.value
@@ -481,93 +2759,508 @@ def handle_resultados(from_number: str, content: str, paciente: dict) -> str:
         clear_paciente(from_number)
         return f"Solicitamos envío de resultados para {paciente['nombre']} ({paciente['dni']}) en {paciente['localidad']}."
 
-def handle_image(from_number: str, content: str, paciente: dict) -> str:
+def handle_image(from_number: str, content, paciente: dict) -> str:
+    # content llega en bytes desde WhatsApp y en base64 desde el widget web
     try:
-        compressed = compress_image(base64.b64decode(content))
-        b64 = base64.b64encode(compressed).decode()
-        ocr_data = call_ocr_service(b64)
-        texto_ocr = ocr_data.get("text","").strip()
-        if not texto_ocr:
-            return "No pudimos procesar tu orden médica."
-        prompt = (
-            f"Analiza esta orden médica y devuelve un JSON con las claves:\n"
-            f"estudios, cobertura, afiliado.\n\n{texto_ocr}"
+        img_bytes = content if isinstance(content, bytes) else base64.b64decode(content)
+        compressed = compress_image(img_bytes)
+        del img_bytes
+    except Exception as e:
+        logger.error(f"Error procesando imagen: {e}")
+        return "Error interpretando tu orden médica."
+    try:
+        resultado = analizar_orden(compressed)
+    except Exception as e:
+        # OCR u OpenAI caídos: se siguen los estudios a mano y la foto queda
+        # guardada por si el caso termina en un operador
+        logger.error(f"Error analizando orden médica, se piden los estudios a mano: {e}")
+        metrica_inc("alia_ordenes_degradadas_total")
+        guardar_imagen_paciente(from_number, compressed)
+        paciente["imagen_hash"] = hash_imagen(compressed)
+        paciente["estado"] = BotState.ESPERANDO_ESTUDIOS_MANUAL.value
+        save_paciente(from_number, paciente)
+        return (
+            "Recibimos la foto de tu orden pero no podemos leerla en este momento.\n"
+            "Por favor, escribe los estudios solicitados separados por comas:"
         )
-        resp = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[{"role":"user","content":prompt}],
-            temperature=0.0
+    try:
+        if not resultado["texto"]:
+            return "No pudimos procesar tu orden médica."
+        datos = resultado["datos"]
+        estudios = datos.get("estudios") or []
+        estudios, desconocidos = catalogo_estudios.canonicalizar(
+            separar_estudios(estudios) if isinstance(estudios, str) else estudios
         )
-        datos = json.loads(resp.choices[0].message.content.strip())
         paciente.update({
-            "estudios": datos.get("estudios"),
+            "estudios": estudios,
             "cobertura": datos.get("cobertura"),
             "afiliado": datos.get("afiliado"),
-            "imagen_base64": content
+            "imagen_hash": hash_imagen(compressed)
         })
+        guardar_imagen_paciente(from_number, compressed)
         save_paciente(from_number, paciente)
         paciente["estado"] = BotState.ESPERANDO_ESTUDIOS_CONFIRMACION.value
-        return f"Hemos detectado estos estudios: {', '.join(paciente['estudios'])}.\n¿Los confirmas? (sí/no)"
+        return (
+            f"Hemos detectado estos estudios: {', '.join(estudios)}.{_aviso_desconocidos(desconocidos)}\n"
+            "¿Los confirmas? (sí/no)"
+        )
     except Exception as e:
         logger.error(f"Error procesando imagen: {e}")
         return "Error interpretando tu orden médica."
 
-def procesar_mensaje_alia(from_number: str, tipo: str, contenido: str) -> str:
-    paciente = get_paciente(from_number)
-    estado   = BotState(paciente.get("estado") or BotState.NONE.value)
-    txt      = contenido.strip().lower()
+def procesar_mensaje_alia(from_number: str, tipo: str, contenido) -> str:
+    # Unidad de trabajo: los cambios de sesión se vuelcan una vez al final
+    inicio, resultado = time.time(), "error"
+    _contexto.etapas = []
+    fence = adquirir_lock_conversacion(from_number)
+    try:
+        paciente = get_paciente(from_number)
+    except Exception:
+        liberar_lock_conversacion(from_number, fence)
+        raise
+    paciente.fence = fence
+    estado = BotState(paciente.get("estado") or BotState.NONE.value).name
+    _contexto.estado = estado
+    _contexto.unidad = paciente
+    try:
+        with lease_vivo(_key_lock_conversacion(from_number), str(fence), LOCK_CONV_TTL):
+            respuesta = _procesar_mensaje(from_number, tipo, contenido, paciente)
+        resultado = "ok"
+        return respuesta
+    finally:
+        _contexto.unidad = None
+        try:
+            _volcar_paciente(from_number, paciente)
+        finally:
+            liberar_lock_conversacion(from_number, fence)
+            duracion = time.time() - inicio
+            metrica_observar("alia_mensaje_segundos", duracion, estado=estado, tipo=tipo, resultado=resultado)
+            if duracion * 1000 > SLOW_REQUEST_MS:
+                logger.warning(
+                    f"Mensaje lento de {from_number} ({estado}/{tipo}): {duracion:.2f}s "
+                    f"[{_desglose_etapas(_contexto.etapas)}]"
+                )
+            _contexto.estado = None
+            _contexto.etapas = None
+
+def mostrar_menu(from_number: str, paciente: dict) -> str:
+    paciente["estado"] = BotState.MENU.value
+    save_paciente(from_number, paciente)
+    return (
+        "Hola! Soy ALIA, tu asistente IA de laboratorio. Elige una opción:\n"
+        "1. Pedir un turno\n"
+        "2. Solicitar envío de resultados\n"
+        "3. Contactar con un operador"
+    )
+
+def handle_saludo(from_number: str, content: str, paciente: dict) -> str:
+    if not any(k in content.strip().lower() for k in ["hola","buenas"]):
+        return None
+    return mostrar_menu(from_number, paciente)
+
+def responder_intencion(intencion: str, from_number: str, content: str, paciente: dict) -> str:
+    if intencion == "saludo":
+        return mostrar_menu(from_number, paciente)
+    if intencion == "sedes":
+        return respuesta_sedes(content)
+    if intencion == "domicilio":
+        return respuesta_domicilio(content)
+    return clasificador_intenciones.respuestas[intencion]
+
+def handle_consulta_libre(from_number: str, content: str, paciente: dict) -> str:
+    # Primero las intenciones locales, después el cache por pregunta
+    # normalizada y recién entonces OpenAI
+    intencion, puntaje = clasificador_intenciones.clasificar(content)
+    etiqueta = intencion or "ninguna"
+    if puntaje >= clasificador_intenciones.umbral:
+        metrica_inc("alia_intenciones_total", intencion=etiqueta, resultado="local")
+        return responder_intencion(intencion, from_number, content, paciente)
+    key = clave_consulta(content)
+    cached = redis_client.get(key)
+    if cached:
+        metrica_inc("alia_intenciones_total", intencion=etiqueta, resultado="cache")
+        return cached
+    metrica_inc("alia_intenciones_total", intencion=etiqueta, resultado="llm")
+    logger.info(f"Consulta libre a OpenAI (intención {etiqueta}, puntaje {puntaje:.2f})")
+    try:
+        if hay_emisor():
+            partes = []
+            for delta in llm_stream(f"Pregunta: {content}"):
+                partes.append(delta)
+                emitir_parcial("token", delta)
+            respuesta = "".join(partes).strip()
+        else:
+            respuesta = llm_completar(f"Pregunta: {content}")
+        if respuesta:
+            redis_client.set(key, respuesta, ex=CONSULTA_CACHE_TTL)
+        return respuesta
+    except CircuitoAbierto as e:
+        logger.warning(f"Consulta libre sin OpenAI: {e}")
+        return (
+            "En este momento no puedo responder consultas abiertas.\n"
+            "Escribe 'hola' para pedir un turno, solicitar resultados o hablar con un operador."
+        )
+    except Exception as e:
+        logger.error(f"Error en fallback GPT: {e}")
+        return "No entendí tu consulta, ¿podrías reformularla?"
+
+# --- Máquina de estados de la conversación -----------------------------------
+# Tabla (estado, tipo de mensaje) -> transición. El validador corre antes del
+# handler y, si falla, se responde mensaje_invalido sin cambiar de estado.
+# Un handler que devuelve None deja el mensaje a la consulta libre.
+# "siguientes" declara a qué estados puede llevar el handler (para diagramas
+# y para recorrer todas las transiciones en pruebas).
+class Transicion:
+    __slots__ = ("handler", "validador", "mensaje_invalido", "siguientes")
+
+    def __init__(self, handler, siguientes=(), validador=None, mensaje_invalido=None):
+        self.handler          = handler
+        self.siguientes       = tuple(siguientes)
+        self.validador        = validador
+        self.mensaje_invalido = mensaje_invalido
 
+CAMPO_POR_ESTADO = {
+    BotState.ESPERANDO_NOMBRE:               "nombre",
+    BotState.ESPERANDO_DIRECCION:            "direccion",
+    BotState.ESPERANDO_LOCALIDAD:            "localidad",
+    BotState.ESPERANDO_FECHA_NACIMIENTO:     "fecha_nacimiento",
+    BotState.ESPERANDO_COBERTURA:            "cobertura",
+    BotState.ESPERANDO_AFILIADO:             "afiliado",
+    BotState.ESPERANDO_RESULTADOS_NOMBRE:    "nombre",
+    BotState.ESPERANDO_RESULTADOS_DNI:       "dni",
+    BotState.ESPERANDO_RESULTADOS_LOCALIDAD: "localidad",
+}
+
+_ESTADOS_DATOS = (
+    BotState.ESPERANDO_NOMBRE, BotState.ESPERANDO_DIRECCION,
+    BotState.ESPERANDO_LOCALIDAD, BotState.ESPERANDO_FECHA_NACIMIENTO,
+    BotState.ESPERANDO_COBERTURA, BotState.ESPERANDO_AFILIADO
+)
+
+def _transicion_datos(validador=None, mensaje_invalido=None) -> Transicion:
+    return Transicion(handle_datos_secuenciales, _ESTADOS_DATOS + (BotState.ESPERANDO_ORDEN,),
+                      validador, mensaje_invalido)
+
+TRANSICIONES = {
+    (BotState.NONE, "text"):         Transicion(handle_saludo, (BotState.MENU,)),
+    (BotState.MENU, "text"):         Transicion(handle_menu, (BotState.MENU_TURNO, BotState.ESPERANDO_RESULTADOS_NOMBRE, BotState.NONE)),
+    (BotState.MENU_TURNO, "text"):   Transicion(handle_menu_turno, _ESTADOS_DATOS + (BotState.ESPERANDO_ORDEN,)),
+    (BotState.ESPERANDO_NOMBRE, "text"):           _transicion_datos(),
+    (BotState.ESPERANDO_DIRECCION, "text"):        _transicion_datos(),
+    (BotState.ESPERANDO_LOCALIDAD, "text"):        _transicion_datos(),
+    (BotState.ESPERANDO_FECHA_NACIMIENTO, "text"): _transicion_datos(
+        validate_fecha_nacimiento, "Formato de fecha inválido (dd/mm/aaaa). Intenta de nuevo:"),
+    (BotState.ESPERANDO_COBERTURA, "text"):        _transicion_datos(),
+    (BotState.ESPERANDO_AFILIADO, "text"):         _transicion_datos(
+        validate_afiliado, "Número de afiliado inválido. Usa solo letras y números:"),
+    (BotState.ESPERANDO_ORDEN, "text"):  Transicion(handle_esperando_orden, (BotState.ESPERANDO_ESTUDIOS_MANUAL,)),
+    (BotState.ESPERANDO_ORDEN, "image"): Transicion(handle_image, (BotState.ESPERANDO_ESTUDIOS_CONFIRMACION, BotState.ESPERANDO_ESTUDIOS_MANUAL)),
+    (BotState.ESPERANDO_ESTUDIOS_MANUAL, "text"):       Transicion(handle_estudios_manual, (BotState.ESPERANDO_ESTUDIOS_CONFIRMACION,)),
+    (BotState.ESPERANDO_ESTUDIOS_CONFIRMACION, "text"): Transicion(handle_estudios_confirmacion, (BotState.NONE, BotState.ESPERANDO_ESTUDIOS_MANUAL)),
+    (BotState.ESPERANDO_RESULTADOS_NOMBRE, "text"):     Transicion(handle_resultados, (BotState.ESPERANDO_RESULTADOS_DNI,)),
+    (BotState.ESPERANDO_RESULTADOS_DNI, "text"):        Transicion(handle_resultados, (BotState.ESPERANDO_RESULTADOS_LOCALIDAD,)),
+    (BotState.ESPERANDO_RESULTADOS_LOCALIDAD, "text"):  Transicion(handle_resultados, (BotState.NONE,)),
+}
+
+def describir_flujo() -> list:
+    return [
+        {
+            "estado": estado.name, "tipo": tipo, "handler": t.handler.__name__,
+            "validador": t.validador.__name__ if t.validador else None,
+            "siguientes": [s.name for s in t.siguientes]
+        }
+        for (estado, tipo), t in TRANSICIONES.items()
+    ]
+
+def flujo_dot() -> str:
+    lineas = ["digraph alia {", "  rankdir=LR;"]
+    for t in describir_flujo():
+        for destino in t["siguientes"]:
+            lineas.append(f'  {t["estado"]} -> {destino} [label="{t["tipo"]}: {t["handler"]}"];')
+    lineas.append("}")
+    return "\n".join(lineas)
+
+def _procesar_mensaje(from_number: str, tipo: str, contenido, paciente: dict) -> str:
+    estado = BotState(paciente.get("estado") or BotState.NONE.value)
+
+    if tipo == "text" and "reiniciar" in contenido.strip().lower():
+        clear_paciente(from_number)
+        return "Flujo reiniciado. ¿En qué puedo ayudarte hoy?"
+
+    transicion = TRANSICIONES.get((estado, tipo))
+    if transicion is None:
+        if tipo == "text":
+            return handle_consulta_libre(from_number, contenido, paciente)
+        return "No pude procesar tu mensaje."
+    if transicion.validador is not None and not transicion.validador(contenido):
+        return transicion.mensaje_invalido
+    with medir("handler"):
+        respuesta = transicion.handler(from_number, contenido, paciente)
+    if respuesta is None and tipo == "text":
+        return handle_consulta_libre(from_number, contenido, paciente)
+    return respuesta
+
+# --- Procesamiento de eventos WhatsApp --------------------------------------
+def descargar_media_whatsapp(media_id: str) -> bytes:
+    meta = http_request(
+        "GET", f"{GRAPH_API_URL}/{media_id}", 5,
+        params={"access_token": META_ACCESS_TOKEN}
+    ).json()
+    url = meta.get("url")
+    if meta.get("file_size") and int(meta["file_size"]) > IMAGEN_MAX_BYTES:
+        raise ValueError(f"Imagen demasiado grande: {meta['file_size']} bytes")
+    buf = io.BytesIO()
+    with http_request("GET", url, 10, headers={"Authorization": f"Bearer {META_ACCESS_TOKEN}"},
+                      stream=True) as resp:
+        resp.raise_for_status()
+        for chunk in resp.iter_content(chunk_size=65536):
+            buf.write(chunk)
+            if buf.tell() > IMAGEN_MAX_BYTES:
+                raise ValueError(f"Imagen demasiado grande: más de {IMAGEN_MAX_BYTES} bytes")
+    return buf.getvalue()
+
+def validar_mensaje_whatsapp(msg: dict) -> str:
+    # Devuelve el motivo de rechazo, o None si el mensaje es procesable
+    if not msg.get("from") or not msg.get("type"):
+        return "Missing fields"
+    if msg.get("type") == "image" and not msg.get("image",{}).get("id"):
+        return "Missing image ID"
+    return None
+
+def procesar_evento_whatsapp(msg: dict):
+    from_nr = msg.get("from")
+    tipo    = msg.get("type")
     if tipo == "text":
-        if "reiniciar" in txt:
-            clear_paciente(from_number)
-            return "Flujo reiniciado. ¿En qué puedo ayudarte hoy?"
-        if estado == BotState.NONE and any(k in txt for k in ["hola","buenas"]):
-            paciente["estado"] = BotState.MENU.value
-            save_paciente(from_number, paciente)
-            return (
-                "Hola! Soy ALIA, tu asistente IA de laboratorio. Elige una opción:\n"
-                "1. Pedir un turno\n"
-                "2. Solicitar envío de resultados\n"
-                "3. Contactar con un operador"
-            )
-        if estado == BotState.MENU:
-            return handle_menu(from_number, contenido, paciente)
-        if estado == BotState.MENU_TURNO:
-            return handle_menu_turno(from_number, contenido, paciente)
-        if estado == BotState.ESPERANDO_ORDEN:
-            return handle_esperando_orden(from_number, contenido, paciente)
-        if estado == BotState.ESPERANDO_ESTUDIOS_MANUAL:
-            return handle_estudios_manual(from_number, contenido, paciente)
-        if estado == BotState.ESPERANDO_ESTUDIOS_CONFIRMACION:
-            return handle_estudios_confirmacion(from_number, contenido, paciente)
-        if estado in [
-            BotState.ESPERANDO_RESULTADOS_NOMBRE,
-            BotState.ESPERANDO_RESULTADOS_DNI,
-            BotState.ESPERANDO_RESULTADOS_LOCALIDAD
-        ]:
-            return handle_resultados(from_number, contenido, paciente)
-        if estado in [
-            BotState.ESPERANDO_NOMBRE, BotState.ESPERANDO_DIRECCION,
-            BotState.ESPERANDO_LOCALIDAD, BotState.ESPERANDO_FECHA_NACIMIENTO,
-            BotState.ESPERANDO_COBERTURA, BotState.ESPERANDO_AFILIADO
-        ]:
-            return handle_datos_secuenciales(from_number, contenido, paciente)
+        txt = msg.get("text",{}).get("body","")
+        rply = procesar_mensaje_alia(from_nr, "text", txt)
+        enviar_mensaje_whatsapp(from_nr, rply)
+    elif tipo == "image":
+        img = descargar_media_whatsapp(msg["image"]["id"])
+        rply = procesar_mensaje_alia(from_nr, "image", img)
+        enviar_mensaje_whatsapp(from_nr, rply)
+
+# --- Cola de ingesta del webhook (Redis) -------------------------------------
+# Cada teléfono cae siempre en el mismo shard y cada shard tiene un único
+# consumidor (lease en Redis), así se respeta el orden por paciente aunque
+# haya varios procesos. Cambiar WEBHOOK_WORKERS con la cola llena reparte
+# los teléfonos de nuevo: vaciarla antes. Mientras un job corre, el lease
+# del shard se renueva con lease_vivo; un job que falla se reintenta con
+# backoff y, agotados los intentos, va a webhook:fallidos.
+WEBHOOK_LEASE_TTL = 30
+WEBHOOK_FALLIDOS  = "webhook:fallidos"
+
+_LUA_RENOVAR_LEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_LUA_LIBERAR_LEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+def shard_de(clave: str, n: int) -> int:
+    return zlib.crc32(clave.encode()) % n
+
+def adquirir_lease(key: str, token: str, ttl: int) -> bool:
+    if redis_client.set(key, token, nx=True, ex=ttl):
+        return True
+    return bool(redis_client.eval(_LUA_RENOVAR_LEASE, 1, key, token, ttl))
+
+def liberar_lease(key: str, token: str):
+    try:
+        redis_client.eval(_LUA_LIBERAR_LEASE, 1, key, token)
+    except redis.RedisError as e:
+        logger.error(f"Error liberando lease {key}: {e}")
 
+# --- Latidos: renovación de leases durante trabajos largos --------------------
+# Un job del webhook, una tanda de envíos o un mensaje con OCR pueden durar
+# más que el TTL de su lease. Mientras dura el bloque `with lease_vivo(...)`
+# un único hilo renueva cada lease registrado cada ttl/3; si al renovar la
+# clave ya es de otro, se marca el evento que devuelve el context manager.
+# No mira _detener: en el apagado los jobs en curso siguen necesitándolo.
+_latidos      = {}
+_latidos_lock = threading.Lock()
+_hilo_latidos = None
+
+def _loop_latidos():
+    while True:
+        time.sleep(0.5)
+        ahora = time.time()
+        with _latidos_lock:
+            vencidos = [(k, l) for k, l in _latidos.items() if l["proximo"] <= ahora]
+        for (key, token), latido in vencidos:
+            try:
+                if redis_client.eval(_LUA_RENOVAR_LEASE, 1, key, token, latido["ttl"]):
+                    latido["proximo"] = ahora + latido["ttl"] / 3
+                    continue
+                logger.error(f"Lease {key} perdido mientras se usaba")
+                latido["perdido"].set()
+                with _latidos_lock:
+                    _latidos.pop((key, token), None)
+            except redis.RedisError as e:
+                logger.error(f"Error Redis renovando lease {key}: {e}")
+
+def iniciar_latidos():
+    global _hilo_latidos
+    if _hilo_latidos is not None:
+        return
+    with _latidos_lock:
+        if _hilo_latidos is None:
+            _hilo_latidos = threading.Thread(target=_loop_latidos, name="latidos", daemon=True)
+            _hilo_latidos.start()
+
+@contextmanager
+def lease_vivo(key: str, token: str, ttl: float):
+    latido = {"ttl": max(1, int(ttl)), "proximo": time.time() + ttl / 3, "perdido": threading.Event()}
+    with _latidos_lock:
+        _latidos[(key, token)] = latido
+    iniciar_latidos()
+    try:
+        yield latido["perdido"]
+    finally:
+        with _latidos_lock:
+            _latidos.pop((key, token), None)
+
+def _cola_webhook(shard: int) -> str:
+    return f"webhook:cola:{shard}"
+
+def encolar_mensaje_whatsapp(msg: dict):
+    shard = shard_de(msg["from"], WEBHOOK_WORKERS)
+    job = json.dumps({"msg": msg, "encolado": time.time()})
+    redis_client.lpush(_cola_webhook(shard), job)
+    metrica_inc("alia_webhook_encolados_total")
+
+def _procesar_job_webhook(raw: str) -> bool:
+    # False si el apagado cortó los reintentos: el job queda en proc y lo
+    # retoma el próximo dueño del shard
+    job = json.loads(raw)
+    metrica_observar("alia_webhook_cola_lag_segundos", time.time() - job["encolado"])
+    inicio = time.time()
+    try:
+        for intento in range(1, WEBHOOK_REINTENTOS + 1):
+            try:
+                procesar_evento_whatsapp(job["msg"])
+                metrica_inc("alia_webhook_procesados_total", resultado="ok")
+                return True
+            except Exception as e:
+                if intento == WEBHOOK_REINTENTOS:
+                    logger.error(f"Error procesando mensaje encolado de {job['msg'].get('from')}, "
+                                 f"va a {WEBHOOK_FALLIDOS} tras {intento} intentos: {e}")
+                    metrica_inc("alia_webhook_procesados_total", resultado="fallido")
+                    pipe = redis_client.pipeline()
+                    pipe.lpush(WEBHOOK_FALLIDOS, json.dumps({**job, "error": str(e)[:500], "fallido": time.time()}))
+                    pipe.ltrim(WEBHOOK_FALLIDOS, 0, 9999)
+                    pipe.execute()
+                    return True
+                logger.warning(f"Error procesando mensaje encolado de {job['msg'].get('from')} (intento {intento}): {e}")
+                metrica_inc("alia_webhook_procesados_total", resultado="reintento")
+                if _detener.wait(min(30, 2 ** intento) * random.uniform(0.5, 1)):
+                    return False
+    finally:
+        metrica_observar("alia_webhook_proceso_segundos", time.time() - inicio)
+
+def worker_webhook(shard: int):
+    cola, proc = _cola_webhook(shard), f"webhook:proc:{shard}"
+    lease, token = f"webhook:lease:{shard}", uuid.uuid4().hex
+    tengo_lease = False
+    while not _detener.is_set():
         try:
-            resp = openai.ChatCompletion.create(
-                model="gpt-4",
-                messages=[{"role":"user","content":f"Pregunta: {contenido}"}],
-                temperature=0.0
-            )
-            return resp.choices[0].message.content.strip()
-        except Exception as e:
-            logger.error(f"Error en fallback GPT: {e}")
-            return "No entendí tu consulta, ¿podrías reformularla?"
+            if not adquirir_lease(lease, token, WEBHOOK_LEASE_TTL):
+                tengo_lease = False
+                _detener.wait(WEBHOOK_LEASE_TTL / 3)
+                continue
+            if not tengo_lease:
+                # Lo que quedó en proceso de un consumidor caído va primero
+                while redis_client.lmove(proc, cola, "LEFT", "RIGHT"):
+                    pass
+                tengo_lease = True
+            raw = redis_client.blmove(cola, proc, 1, "RIGHT", "LEFT")
+            if raw is None:
+                continue
+            with lease_vivo(lease, token, WEBHOOK_LEASE_TTL) as perdido:
+                terminado = _procesar_job_webhook(raw)
+            if perdido.is_set():
+                # Otro worker ya devolvió proc a la cola: este job puede repetirse
+                tengo_lease = False
+            if terminado:
+                redis_client.lrem(proc, 1, raw)
+        except redis.RedisError as e:
+            logger.error(f"Error Redis en worker de webhook {shard}: {e}")
+            _detener.wait(1)
+    liberar_lease(lease, token)
+
+_workers_webhook = []
+
+def iniciar_workers_webhook():
+    if _workers_webhook:
+        return
+    for shard in range(WEBHOOK_WORKERS):
+        t = threading.Thread(target=worker_webhook, args=(shard,), name=f"webhook-{shard}", daemon=True)
+        t.start()
+        _workers_webhook.append(t)
+    logger.info(f"Workers de webhook iniciados: {WEBHOOK_WORKERS}")
+
+@registrar_colector
+def _colector_cola_webhook():
+    pipe = redis_client.pipeline(transaction=False)
+    for shard in range(WEBHOOK_WORKERS):
+        pipe.llen(_cola_webhook(shard))
+    pipe.llen(WEBHOOK_FALLIDOS)
+    largos = pipe.execute()
+    metrica_set("alia_webhook_cola_profundidad", sum(largos[:-1]))
+    metrica_set("alia_webhook_fallidos", largos[-1])
 
-    if tipo == "image" and estado == BotState.ESPERANDO_ORDEN:
-        return handle_image(from_number, contenido, paciente)
+# --- Lotes del webhook: extracción, deduplicación y orden por remitente ------
+_executor_lotes = ThreadPoolExecutor(max_workers=WEBHOOK_BATCH_HILOS, thread_name_prefix="lote")
 
-    return "No pude procesar tu mensaje."
+def extraer_mensajes(data: dict) -> list:
+    mensajes = []
+    for entry in data.get("entry") or []:
+        for change in entry.get("changes") or []:
+            mensajes.extend((change.get("value") or {}).get("messages") or [])
+    return mensajes
+
+def marcar_mensaje_visto(msg: dict) -> bool:
+    # True si es la primera vez que vemos este id (o si Meta no mandó id)
+    mid = msg.get("id")
+    if not mid:
+        return True
+    return bool(redis_client.set(f"webhook:visto:{mid}", 1, nx=True, ex=WEBHOOK_DEDUP_TTL))
+
+def desmarcar_mensaje_visto(msg: dict):
+    if msg.get("id"):
+        redis_client.delete(f"webhook:visto:{msg['id']}")
+
+def agrupar_por_remitente(mensajes: list) -> dict:
+    grupos = defaultdict(list)
+    for msg in mensajes:
+        grupos[msg["from"]].append(msg)
+    for msgs in grupos.values():
+        msgs.sort(key=lambda m: int(m.get("timestamp") or 0))
+    return grupos
+
+def _procesar_mensajes_remitente(msgs: list) -> int:
+    fallidos = 0
+    for msg in msgs:
+        try:
+            procesar_evento_whatsapp(msg)
+        except Exception as e:
+            logger.error(f"Error procesando mensaje WhatsApp de {msg.get('from')}: {e}")
+            desmarcar_mensaje_visto(msg)
+            fallidos += 1
+    return fallidos
+
+def procesar_lote_whatsapp(mensajes: list) -> int:
+    # Concurrente entre remitentes, secuencial dentro de cada remitente
+    grupos = agrupar_por_remitente(mensajes)
+    if len(grupos) == 1:
+        return _procesar_mensajes_remitente(next(iter(grupos.values())))
+    futuros = [_executor_lotes.submit(_procesar_mensajes_remitente, msgs) for msgs in grupos.values()]
+    return sum(f.result() for f in futuros)
 
 # --- Webhook WhatsApp (verificación y eventos) -------------------------------
 @app.route("/webhook", methods=["GET","POST"])
@@ -585,39 +3278,98 @@ def webhook_whatsapp():
         return Response("No event", status=200)
 
     try:
-        msg = data["entry"][0]["changes"][0]["value"]["messages"][0]
+        mensajes = extraer_mensajes(data)
     except Exception:
         return Response("Invalid event", status=400)
+    if not mensajes:
+        # Callbacks de estado (entregado/leído) no traen mensajes
+        return Response("No messages", status=200)
 
-    from_nr = msg.get("from")
-    tipo    = msg.get("type")
-    if not from_nr or not tipo:
-        return Response("Missing fields", status=400)
+    validos, errores = [], []
+    for msg in mensajes:
+        error = validar_mensaje_whatsapp(msg)
+        if error:
+            logger.warning(f"Mensaje WhatsApp descartado ({error}): {msg.get('id')}")
+            errores.append(error)
+        else:
+            validos.append(msg)
+    if not validos:
+        return Response(errores[0], status=400)
 
-    if tipo == "text":
-        txt = msg.get("text",{}).get("body","")
-        rply = procesar_mensaje_alia(from_nr, "text", txt)
-        enviar_mensaje_whatsapp(from_nr, rply)
-    elif tipo == "image":
-        mid = msg.get("image",{}).get("id")
-        if not mid:
-            return Response("Missing image ID", status=400)
-        try:
-            meta = requests.get(
-                f"https://graph.facebook.com/v16.0/{mid}",
-                params={"access_token": META_ACCESS_TOKEN}, timeout=5
-            ).json()
-            url = meta.get("url")
-            img = requests.get(url, timeout=10).content
-            b64 = base64.b64encode(img).decode()
-            rply = procesar_mensaje_alia(from_nr, "image", b64)
-            enviar_mensaje_whatsapp(from_nr, rply)
-        except Exception as e:
-            logger.error(f"Error imagen WhatsApp: {e}")
-            return Response("Error processing image", status=400)
+    try:
+        nuevos = [m for m in validos if marcar_mensaje_visto(m)]
+    except redis.RedisError as e:
+        logger.error(f"Error deduplicando lote del webhook: {e}")
+        return Response("Dedup unavailable", status=503)
+    metrica_inc("alia_webhook_mensajes_total", len(nuevos), resultado="nuevo")
+    metrica_inc("alia_webhook_mensajes_total", len(validos) - len(nuevos), resultado="duplicado")
+    if not nuevos:
+        return Response("OK", status=200)
+
+    if WEBHOOK_MODO == "cola":
+        for i, msg in enumerate(nuevos):
+            try:
+                encolar_mensaje_whatsapp(msg)
+            except redis.RedisError as e:
+                logger.error(f"Error encolando mensaje de {msg.get('from')}: {e}")
+                for pendiente in nuevos[i:]:
+                    desmarcar_mensaje_visto(pendiente)
+                return Response("Queue unavailable", status=503)
+        return Response("OK", status=200)
+
+    if procesar_lote_whatsapp(nuevos):
+        return Response("Error processing message", status=400)
 
     return Response("OK", status=200)
 
+@app.before_request
+def _inicio_request():
+    g.inicio_request = time.time()
+
+@app.after_request
+def _fin_request(response):
+    inicio = getattr(g, "inicio_request", None)
+    if inicio is not None:
+        duracion = time.time() - inicio
+        ruta = request.url_rule.rule if request.url_rule else "-"
+        metrica_observar("alia_request_segundos", duracion, ruta=ruta, metodo=request.method,
+                         status=response.status_code)
+        if duracion * 1000 > SLOW_REQUEST_MS:
+            logger.warning(f"Request lento {request.method} {ruta}: {duracion:.2f}s (status {response.status_code})")
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def serve_metrics():
+    return Response(render_metricas(), mimetype="text/plain; version=0.0.4")
+
+# --- Salud: liveness y readiness ---------------------------------------------
+# /healthz solo confirma que el proceso atiende. /readyz revisa los upstreams:
+# sin Redis no se puede procesar nada (503); Sheets y OpenAI caídos, o un
+# circuito abierto, degradan pero no sacan la instancia de servicio.
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    return jsonify({"status": "ok"})
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    dependencias = {}
+    try:
+        redis_client.ping()
+        dependencias["redis"] = "ok"
+    except redis.RedisError as e:
+        dependencias["redis"] = f"error: {e}"
+    for nombre, construir in (("sheets", cliente_sheets), ("openai", cliente_openai)):
+        try:
+            construir()
+            dependencias[nombre] = "ok"
+        except Exception as e:
+            dependencias[nombre] = f"error: {e}"
+    circuitos = {nombre: _NOMBRES_CIRCUITO[c.estado] for nombre, c in _circuitos.items()}
+    listo = dependencias["redis"] == "ok"
+    sano = all(v == "ok" for v in dependencias.values()) and all(v == "cerrado" for v in circuitos.values())
+    estado = "ok" if sano else ("degradado" if listo else "no_listo")
+    return jsonify({"status": estado, "dependencias": dependencias, "circuitos": circuitos}), 200 if listo else 503
+
 # --- Widget & página de ejemplo ----------------------------------------------
 @app.route("/widget.js")
 def serve_widget():
@@ -631,18 +3383,238 @@ def serve_index():
 def serve_chat():
     return send_from_directory(app.static_folder, "chat.html")
 
+def _procesar_chat(session: str, data: dict) -> str:
+    if "image" in data and (data["image"].startswith("iVBOR") or data["image"].startswith("/9j/")):
+        return procesar_mensaje_alia(session, "image", data["image"])
+    msg = data.get("message","").strip()
+    return procesar_mensaje_alia(session, "text", msg)
+
+def _stream_chat(session: str, data: dict):
+    # NDJSON: una línea {"delta": ...} por token y al final {"reply": ...}
+    salida = queue.Queue()
+
+    def procesar():
+        _contexto.emisor = lambda tipo, texto: salida.put({"delta": texto} if tipo == "token" else {tipo: texto})
+        try:
+            salida.put({"reply": _procesar_chat(session, data)})
+        except Exception as e:
+            logger.error(f"Error en chat con stream ({session}): {e}")
+            salida.put({"reply": "No pude procesar tu mensaje."})
+        finally:
+            _contexto.emisor = None
+            salida.put(None)
+
+    threading.Thread(target=procesar, daemon=True).start()
+    while True:
+        evento = salida.get()
+        if evento is None:
+            return
+        yield json.dumps(evento) + "\n"
+
+# --- Canal de eventos del widget (Server-Sent Events) ------------------------
+# Cada sesión del widget (ALIA_sessionId) abre un único GET /chat/eventos que
+# queda abierto; los POST /chat con canal "sse" publican estados, tokens y la
+# respuesta final en un stream de Redis por sesión, así el POST y el SSE
+# pueden caer en workers distintos y una reconexión retoma desde
+# Last-Event-ID sin perder eventos.
+# Con gthread cada stream abierto ocupa un hilo del worker: se admiten hasta
+# CHAT_SSE_MAX por proceso (el resto recibe 503 y el widget usa la respuesta
+# del POST), cada stream se cierra a los ~CHAT_SSE_VIDA segundos para que el
+# navegador reconecte y se reparta, y en el apagado se cierran enseguida
+# (cerrar_eventos_chat, desde SIGTERM) para no trabar la espera de gunicorn.
+CHAT_EVENTOS_TTL = 3600
+CHAT_EVENTOS_MAX = 500
+CHAT_SSE_PING    = 15   # segundos sin eventos antes de mandar un keep-alive
+
+_ID_STREAM = re.compile(r"^\d+-\d+$")
+_sse_cupos  = threading.BoundedSemaphore(CHAT_SSE_MAX)
+_cerrar_sse = threading.Event()
+
+def cerrar_eventos_chat():
+    _cerrar_sse.set()
+
+def _stream_eventos_chat(session: str) -> str:
+    return f"chat:eventos:{session}"
+
+def publicar_evento_chat(session: str, tipo: str, datos: dict):
+    key = _stream_eventos_chat(session)
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.xadd(key, {"tipo": tipo, "datos": json.dumps(datos)}, maxlen=CHAT_EVENTOS_MAX, approximate=True)
+    pipe.expire(key, CHAT_EVENTOS_TTL)
+    pipe.execute()
+
+def _procesar_chat_sse(session: str, data: dict, mensaje: str) -> str:
+    def emisor(tipo: str, texto: str):
+        try:
+            publicar_evento_chat(session, tipo, {"mensaje": mensaje, "texto": texto})
+        except redis.RedisError as e:
+            logger.error(f"Error publicando evento de chat ({session}): {e}")
+
+    _contexto.emisor = emisor
+    try:
+        reply = _procesar_chat(session, data)
+    except Exception as e:
+        logger.error(f"Error en chat con eventos ({session}): {e}")
+        reply = "No pude procesar tu mensaje."
+    finally:
+        _contexto.emisor = None
+    emisor("respuesta", reply)
+    return reply
+
+def _eventos_chat(session: str, desde: str):
+    key = _stream_eventos_chat(session)
+    if not _ID_STREAM.match(desde):
+        ultimo = redis_client.xrevrange(key, count=1)
+        desde = ultimo[0][0] if ultimo else "0-0"
+    metrica_inc("alia_chat_sse_conexiones_total")
+    yield "retry: 2000\n\n"
+    # Bloqueos cortos: el cierre por SIGTERM se nota en a lo sumo un segundo
+    fin = time.time() + CHAT_SSE_VIDA * random.uniform(0.8, 1)
+    ultimo_envio = time.time()
+    while not (_detener.is_set() or _cerrar_sse.is_set()) and time.time() < fin:
+        resp = redis_client.xread({key: desde}, count=100, block=1000)
+        if not resp:
+            if time.time() - ultimo_envio >= CHAT_SSE_PING:
+                ultimo_envio = time.time()
+                yield ": ping\n\n"
+            continue
+        for entry_id, campos in resp[0][1]:
+            desde = entry_id
+            yield f"id: {entry_id}\nevent: {campos['tipo']}\ndata: {campos['datos']}\n\n"
+        ultimo_envio = time.time()
+
+@app.route("/chat/eventos", methods=["GET"])
+def chat_eventos():
+    session = request.args.get("session", "demo")
+    desde   = request.headers.get("Last-Event-ID", "")
+    if _cerrar_sse.is_set() or not _sse_cupos.acquire(blocking=False):
+        metrica_inc("alia_chat_sse_rechazados_total")
+        return Response("Demasiados canales abiertos", status=503, headers={"Retry-After": "10"})
+    try:
+        resp = Response(
+            stream_with_context(_eventos_chat(session, desde)),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+    except Exception:
+        _sse_cupos.release()
+        raise
+    resp.call_on_close(_sse_cupos.release)
+    return resp
+
 @app.route("/chat", methods=["POST"])
 def api_chat():
     data    = request.get_json(force=True)
     session = data.get("session","demo")
-    if "image" in data and (data["image"].startswith("iVBOR") or data["image"].startswith("/9j/")):
-        reply = procesar_mensaje_alia(session, "image", data["image"])
+    if data.get("canal") == "sse":
+        # La respuesta también vuelve en el POST por si el canal SSE está caído
+        mensaje = str(data.get("id") or uuid.uuid4().hex)
+        return jsonify({"reply": _procesar_chat_sse(session, data, mensaje), "id": mensaje})
+    if data.get("stream"):
+        return Response(stream_with_context(_stream_chat(session, data)), mimetype="application/x-ndjson")
+    return jsonify({"reply": _procesar_chat(session, data)})
+
+# --- API de analytics (lectura y exportación) --------------------------------
+# Protegida con ANALYTICS_TOKEN (Authorization: Bearer ...). Rango por
+# fecha de turno con ?desde=YYYY-MM-DD&hasta=YYYY-MM-DD (default: 30 días).
+def _analytics_rango():
+    if not ANALYTICS_TOKEN:
+        return None, ("", 404)
+    auth = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(auth.encode(), f"Bearer {ANALYTICS_TOKEN}".encode()):
+        return None, (jsonify({"error": "no autorizado"}), 401)
+    try:
+        hasta = datetime.strptime(request.args.get("hasta") or datetime.now().strftime("%Y-%m-%d"), "%Y-%m-%d")
+        desde = request.args.get("desde")
+        desde = datetime.strptime(desde, "%Y-%m-%d") if desde else hasta - timedelta(days=30)
+    except ValueError:
+        return None, (jsonify({"error": "fechas en formato YYYY-MM-DD"}), 400)
+    if desde > hasta:
+        return None, (jsonify({"error": "desde es posterior a hasta"}), 400)
+    return (desde.strftime("%Y-%m-%d"), hasta.strftime("%Y-%m-%d")), None
+
+@app.route("/analytics/<reporte>", methods=["GET"])
+def analytics_reporte(reporte: str):
+    rango, error = _analytics_rango()
+    if error:
+        return error
+    if reporte == "capacidad":
+        datos = capacidad_domicilios(*rango)
+    elif reporte == "sedes":
+        datos = turnos_por_sede(*rango)
+    elif reporte == "estudios":
+        datos = frecuencia_estudios(*rango, limite=request.args.get("limite", 50, type=int))
+    elif reporte == "export":
+        if request.args.get("formato") == "csv":
+            def filas_csv():
+                buf = io.StringIO()
+                escritor = None
+                for ev in exportar_eventos(*rango):
+                    if escritor is None:
+                        escritor = csv.DictWriter(buf, fieldnames=list(ev))
+                        escritor.writeheader()
+                    escritor.writerow(ev)
+                    yield buf.getvalue()
+                    buf.seek(0)
+                    buf.truncate()
+            return Response(filas_csv(), mimetype="text/csv")
+        return Response((json.dumps(ev) + "\n" for ev in exportar_eventos(*rango)), mimetype="application/x-ndjson")
     else:
-        msg   = data.get("message","").strip()
-        reply = procesar_mensaje_alia(session, "text", msg)
-    return jsonify({"reply": reply})
+        return jsonify({"error": f"reporte desconocido: {reporte}"}), 404
+    return jsonify({"desde": rango[0], "hasta": rango[1], "datos": datos})
+
+# --- Servicios de fondo y apagado ordenado ----------------------------------
+# Los usa tanto `python app.py` como gunicorn (hooks en gunicorn.conf.py). Los
+# hilos coordinan entre procesos con leases en Redis, así que cada worker de
+# gunicorn puede levantar los suyos.
+def iniciar_servicios(web: bool = True):
+    threading.Thread(target=precalentar_clientes, name="precalentar", daemon=True).start()
+    iniciar_volcado_metricas()
+    iniciar_flusher_sheets()
+    iniciar_reconciliador_cupos()
+    iniciar_barrido_sesiones()
+    iniciar_despachadores_whatsapp()
+    if not web or (WEBHOOK_MODO == "cola" and WEBHOOK_WORKERS_EN_WEB):
+        iniciar_workers_webhook()
+
+def detener_servicios(timeout: float = 30):
+    # Primero terminan los jobs en curso, después los envíos y al final el
+    # volcado a Sheets de lo que haya quedado en el buffer
+    _detener.set()
+    limite = time.time() + timeout
+    hilos = _workers_webhook + _despachadores_whatsapp + ([_flusher_sheets] if _flusher_sheets else [])
+    for t in hilos:
+        t.join(timeout=max(0.1, limite - time.time()))
+    try:
+        volcar_metricas()
+        retirar_metricas_proceso()
+    except redis.RedisError as e:
+        logger.error(f"Error Redis volcando métricas al apagar: {e}")
+    logger.info("Servicios de fondo detenidos")
 
 # --- Ejecución del servidor --------------------------------------------------
+# Producción: gunicorn -c gunicorn.conf.py app:app (ver Procfile). Este
+# bloque queda para desarrollo local y para el proceso worker.
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["flujo"]:
+        print(flujo_dot())
+        sys.exit(0)
+    if sys.argv[1:2] == ["backfill-analytics"]:
+        # python app.py backfill-analytics [desde YYYY-MM] [hasta YYYY-MM]
+        hasta = sys.argv[3] if len(sys.argv) > 3 else datetime.now().strftime("%Y-%m")
+        desde = sys.argv[2] if len(sys.argv) > 2 else hasta
+        logger.info(f"Backfill de analytics {desde}..{hasta}: {backfill_analytics(desde, hasta)} eventos nuevos")
+        sys.exit(0)
+    if sys.argv[1:2] == ["worker"]:
+        iniciar_servicios(web=False)
+        signal.signal(signal.SIGTERM, lambda *_: _detener.set())
+        try:
+            while not _detener.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        detener_servicios()
+        sys.exit(0)
+    iniciar_servicios()
     puerto = int(os.getenv("PORT",10000))
     app.run(host="0.0.0.0", port=puerto)
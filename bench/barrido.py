@@ -0,0 +1,82 @@
+# Chequeo del barrido de sesiones contra fakeredis: varias vueltas seguidas
+# sobre las mismas sesiones no pueden borrar una conversación activa, y una
+# sesión realmente inactiva sí tiene que desaparecer.
+#
+#   python -m bench.barrido
+#
+# Sale con código 1 si algún caso falla.
+import sys
+
+from bench.fakes import instalar_fakes
+
+instalar_fakes()
+
+import app as alia  # noqa: E402
+
+CONVERSACIONES = {
+    "MENU":                     ["hola"],
+    "MENU_TURNO":               ["hola", "1"],
+    "ESPERANDO_NOMBRE":         ["hola", "1", "2"],
+    "ESPERANDO_DIRECCION":      ["hola", "1", "2", "Juan Perez"],
+    "ESPERANDO_RESULTADOS_DNI": ["hola", "2", "Ana Gomez"],
+}
+SIGUIENTE = {
+    "MENU":                     ("1", "MENU_TURNO"),
+    "MENU_TURNO":               ("2", "ESPERANDO_NOMBRE"),
+    "ESPERANDO_NOMBRE":         ("Juan Perez", "ESPERANDO_DIRECCION"),
+    "ESPERANDO_DIRECCION":      ("Rivadavia 1234", "ESPERANDO_LOCALIDAD"),
+    "ESPERANDO_RESULTADOS_DNI": ("30111222", "ESPERANDO_RESULTADOS_LOCALIDAD"),
+}
+
+def vuelta():
+    cursor = alia.barrer_lote_sesiones(0)
+    while cursor:
+        cursor = alia.barrer_lote_sesiones(cursor)
+
+def estado(tel: str) -> str:
+    return alia._estado_sesion(alia.redis_client.hget(alia._key_paciente(tel), "estado")).name
+
+def main() -> int:
+    fallas = []
+    tels = {}
+    for i, (esperado, mensajes) in enumerate(CONVERSACIONES.items()):
+        tel = f"54911000{i:04d}"
+        for texto in mensajes:
+            alia.procesar_mensaje_alia(tel, "text", texto)
+        if estado(tel) != esperado:
+            fallas.append(f"{tel}: quedó en {estado(tel)}, se esperaba {esperado}")
+        tels[esperado] = tel
+
+    for _ in range(3):
+        vuelta()
+
+    for esperado, tel in tels.items():
+        key = alia._key_paciente(tel)
+        ttl = alia.redis_client.ttl(key)
+        maximo = alia.INACTIVIDAD_POR_ESTADO[alia.BotState[esperado]]
+        if ttl < 0:
+            fallas.append(f"{tel} ({esperado}): sesión borrada tras tres vueltas")
+            continue
+        if ttl > maximo:
+            fallas.append(f"{tel} ({esperado}): TTL {ttl} mayor que la inactividad máxima {maximo}")
+        texto, siguiente = SIGUIENTE[esperado]
+        alia.procesar_mensaje_alia(tel, "text", texto)
+        if estado(tel) != siguiente:
+            fallas.append(f"{tel}: tras '{texto}' quedó en {estado(tel)}, se esperaba {siguiente}")
+
+    # Sin actividad por más que su máximo: la vuelta la borra
+    tel = "549110009999"
+    alia.procesar_mensaje_alia(tel, "text", "hola")
+    key = alia._key_paciente(tel)
+    alia.redis_client.expire(key, alia.SESION_TTL - alia.INACTIVIDAD_POR_ESTADO[alia.BotState.MENU] - 1)
+    vuelta()
+    if alia.redis_client.exists(key):
+        fallas.append(f"{tel}: sesión inactiva no se borró")
+
+    for falla in fallas:
+        print(f"FALLA {falla}")
+    print(f"Barrido: {len(fallas)} fallas")
+    return 1 if fallas else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+# Reemplazos locales de Google Sheets/Drive, OpenAI y Redis para correr
+# app.py sin red. instalar_fakes() tiene que llamarse ANTES de importar app.
+import os
+import json
+import time
+import base64
+import threading
+from types import SimpleNamespace
+
+LATENCIAS = {"openai": 0.0, "sheets": 0.0}
+
+def _dormir(clave: str):
+    if LATENCIAS[clave]:
+        time.sleep(LATENCIAS[clave])
+
+# --- gspread ------------------------------------------------------------------
+class FakeWorksheet:
+    def __init__(self, title: str):
+        self.title = title
+        self.filas = []
+        self._lock = threading.Lock()
+
+    def append_row(self, row, **kwargs):
+        _dormir("sheets")
+        with self._lock:
+            self.filas.append(list(row))
+
+    def append_rows(self, rows, **kwargs):
+        _dormir("sheets")
+        with self._lock:
+            self.filas.extend(list(r) for r in rows)
+
+    def get_all_values(self):
+        _dormir("sheets")
+        with self._lock:
+            return [[str(c) for c in fila] for fila in self.filas]
+
+    def get_all_records(self):
+        _dormir("sheets")
+        with self._lock:
+            if not self.filas:
+                return []
+            headers, datos = self.filas[0], self.filas[1:]
+        return [dict(zip(headers, fila)) for fila in datos]
+
+class FakeSpreadsheet:
+    def __init__(self, title: str):
+        self.title = title
+        self.id = f"fake-{title}"
+        self._tabs = {}
+        self._lock = threading.Lock()
+
+    def share(self, *args, **kwargs):
+        _dormir("sheets")
+
+    def worksheet(self, title: str):
+        import gspread
+        _dormir("sheets")
+        with self._lock:
+            if title not in self._tabs:
+                raise gspread.exceptions.WorksheetNotFound(title)
+            return self._tabs[title]
+
+    def add_worksheet(self, title: str, rows: int = 100, cols: int = 26):
+        _dormir("sheets")
+        with self._lock:
+            ws = self._tabs.setdefault(title, FakeWorksheet(title))
+        return ws
+
+    def worksheets(self):
+        with self._lock:
+            return list(self._tabs.values())
+
+class FakeGspreadClient:
+    def __init__(self):
+        self.libros = {}
+        self._lock = threading.Lock()
+
+    def open(self, name: str):
+        import gspread
+        _dormir("sheets")
+        with self._lock:
+            if name not in self.libros:
+                raise gspread.exceptions.SpreadsheetNotFound(name)
+            return self.libros[name]
+
+    def create(self, name: str):
+        _dormir("sheets")
+        with self._lock:
+            return self.libros.setdefault(name, FakeSpreadsheet(name))
+
+def _fake_drive(*args, **kwargs):
+    ejecutar = SimpleNamespace(execute=lambda: {"parents": []})
+    files = SimpleNamespace(get=lambda **kw: ejecutar, update=lambda **kw: ejecutar)
+    return SimpleNamespace(files=lambda: files)
+
+# --- OpenAI -------------------------------------------------------------------
+RESPUESTA_ORDEN = {"estudios": ["Hemograma", "Glucemia", "Colesterol total"], "cobertura": "OSDE", "afiliado": "A123"}
+
+def _contenido_fake(messages: list) -> str:
+    prompt = messages[-1]["content"]
+    if prompt.startswith("Analiza esta orden"):
+        return json.dumps(RESPUESTA_ORDEN)
+    if "estudios solicitados" in prompt:
+        return "Ayuno de sangre: Ayuno de 8 horas.\nRecolección de orina: No requiere recolección de orina."
+    return "Nuestro horario de atención es de lunes a sábado de 07:40 a 11:00."
+
+def _fake_chat_completion(**kwargs):
+    _dormir("openai")
+    contenido = _contenido_fake(kwargs["messages"])
+    if kwargs.get("stream"):
+        return iter([
+            SimpleNamespace(choices=[SimpleNamespace(delta={"content": palabra + " "})])
+            for palabra in contenido.split(" ")
+        ])
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=contenido))])
+
+# --- Redis -------------------------------------------------------------------
+def _fake_redis_streams():
+    import fakeredis
+
+    class FakeRedisStreams(fakeredis.FakeRedis):
+        # fakeredis 2.23 pierde entradas en XREADGROUP con BLOCK y COUNT: la
+        # primera pasada las marca como entregadas y devuelve None. Se emula
+        # el bloqueo con lecturas no bloqueantes.
+        def xreadgroup(self, groupname, consumername, streams, count=None, block=None, noack=False):
+            limite = time.time() + (block or 0) / 1000
+            while True:
+                resp = super().xreadgroup(groupname, consumername, streams, count=count, noack=noack)
+                if block is None or any(entradas for _, entradas in resp or []) or time.time() >= limite:
+                    return resp
+                time.sleep(0.005)
+
+    return FakeRedisStreams
+
+# --- Instalación ---------------------------------------------------------------
+def instalar_fakes(openai_ms: float = 0, sheets_ms: float = 0, redis_url: str = None) -> FakeGspreadClient:
+    LATENCIAS["openai"] = openai_ms / 1000
+    LATENCIAS["sheets"] = sheets_ms / 1000
+
+    os.environ.setdefault("GOOGLE_CREDS_B64", base64.b64encode(b"{}").decode())
+    os.environ.setdefault("META_ACCESS_TOKEN", "bench")
+    os.environ.setdefault("META_PHONE_NUMBER_ID", "bench")
+    os.environ.setdefault("META_VERIFY_TOKEN", "bench")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+    import gspread
+    import openai
+    import redis
+    import googleapiclient.discovery
+    from google.oauth2 import service_account
+
+    cliente = FakeGspreadClient()
+    gspread.authorize = lambda creds: cliente
+    service_account.Credentials.from_service_account_info = classmethod(lambda cls, info, **kw: SimpleNamespace())
+    googleapiclient.discovery.build = _fake_drive
+    openai.ChatCompletion.create = staticmethod(_fake_chat_completion)
+
+    if redis_url:
+        os.environ["REDIS_URL"] = redis_url
+    else:
+        # fakeredis con soporte Lua (pip install -r requirements-bench.txt)
+        import fakeredis
+        servidor, FakeRedisStreams = fakeredis.FakeServer(), _fake_redis_streams()
+        redis.from_url = lambda url=None, **kw: FakeRedisStreams(server=servidor, **kw)
+    return cliente
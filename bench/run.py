@@ -0,0 +1,170 @@
+# Benchmark de conversaciones completas contra app.py con todos los upstreams
+# reemplazados por fakes locales (Redis, Sheets, OpenAI, Graph, OCR, derivador).
+#
+#   pip install -r requirements.txt -r requirements-bench.txt
+#   python -m bench.run --conversaciones 200 --concurrencia 20 --openai-ms 800 --sheets-ms 300
+#
+# Con --target se le pega a un servidor ya levantado (p. ej. gunicorn con
+# bench.servidor:app); ese proceso tiene que apuntar GRAPH_API_URL,
+# OCR_SERVICE_URL y DERIVADOR_SERVICE_URL al stub que este script levanta en
+# --stub-port (los valores se imprimen al arrancar).
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench.stubs import StubUpstreams
+
+DATOS_PACIENTE = [
+    ("text", "Juan Perez"), ("text", "Rivadavia 1234"), ("text", "Merlo"),
+    ("text", "01/02/1980"), ("text", "OSDE"), ("text", "A123"),
+]
+
+FLUJOS = {
+    "domicilio": [("text", "hola"), ("text", "1"), ("text", "2")] + DATOS_PACIENTE + [
+        ("text", "no"), ("text", "hemograma, glucemia"), ("text", "si")],
+    "sede": [("text", "hola"), ("text", "1"), ("text", "1")] + DATOS_PACIENTE + [
+        ("text", "no"), ("text", "colesterol, tsh"), ("text", "si")],
+    "orden": [("text", "hola"), ("text", "1"), ("text", "2")] + DATOS_PACIENTE + [
+        ("image", None), ("text", "si")],
+    "resultados": [("text", "hola"), ("text", "2"), ("text", "Ana Gomez"), ("text", "30111222"), ("text", "Castelar")],
+    "consulta": [("text", "¿Hasta qué hora atienden los sábados?")],
+}
+
+def payload_webhook(tel: str, tipo: str, contenido: str) -> dict:
+    msg = {"from": tel, "id": f"wamid.{uuid.uuid4().hex}", "timestamp": str(int(time.time())), "type": tipo}
+    if tipo == "text":
+        msg["text"] = {"body": contenido}
+    else:
+        msg["image"] = {"id": contenido}
+    return {"object": "whatsapp_business_account", "entry": [{"changes": [{"value": {"messages": [msg]}}]}]}
+
+def percentil(valores: list, p: float) -> float:
+    if not valores:
+        return float("nan")
+    orden = sorted(valores)
+    return orden[min(len(orden) - 1, int(round(p / 100 * len(orden) + 0.5)) - 1)]
+
+class Resultados:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.e2e = defaultdict(list)
+        self.ack = defaultdict(list)
+        self.errores = defaultdict(int)
+        self.conversaciones = defaultdict(int)
+
+    def registrar(self, flujo: str, ack: float, e2e: float):
+        with self.lock:
+            self.ack[flujo].append(ack)
+            if e2e is None:
+                self.errores[flujo] += 1
+            else:
+                self.e2e[flujo].append(e2e)
+
+def conversar(idx: int, flujo: str, base_url: str, stub: StubUpstreams, res: Resultados,
+              timeout: float, sesion: requests.Session, prefijo: str):
+    tel = f"{prefijo}{idx:06d}"
+    for tipo, contenido in FLUJOS[flujo]:
+        if tipo == "image":
+            contenido = str(idx)
+        previos = stub.cantidad_envios(tel)
+        inicio = time.time()
+        resp = sesion.post(f"{base_url}/webhook", json=payload_webhook(tel, tipo, contenido), timeout=timeout)
+        ack = time.time() - inicio
+        recibido = stub.esperar_respuesta(tel, previos, timeout) if resp.status_code == 200 else None
+        res.registrar(flujo, ack, recibido - inicio if recibido else None)
+        if recibido is None:
+            return
+    with res.lock:
+        res.conversaciones[flujo] += 1
+
+def levantar_app_local(args, stub: StubUpstreams) -> str:
+    from bench.fakes import instalar_fakes
+    stub.configurar_entorno(os.environ)
+    instalar_fakes(args.openai_ms, args.sheets_ms, args.redis_url)
+    import app as alia
+    from werkzeug.serving import make_server
+    if alia.WEBHOOK_MODO == "cola":
+        alia.iniciar_workers_webhook()
+    # El barrido corre como en producción (BARRIDO_SEGUNDOS) sobre las
+    # sesiones que el benchmark deja a medio camino
+    alia.iniciar_barrido_sesiones()
+    servidor = make_server("127.0.0.1", 0, alia.app, threaded=True)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{servidor.server_port}"
+
+def imprimir_reporte(res: Resultados, duracion: float, como_json: bool):
+    filas = []
+    for flujo in sorted(res.ack):
+        e2e = [v * 1000 for v in res.e2e[flujo]]
+        ack = [v * 1000 for v in res.ack[flujo]]
+        filas.append({
+            "flujo": flujo, "conversaciones": res.conversaciones[flujo], "mensajes": len(ack),
+            "errores": res.errores[flujo], "msgs_por_s": round(len(e2e) / duracion, 2),
+            "e2e_p50_ms": round(percentil(e2e, 50), 1), "e2e_p95_ms": round(percentil(e2e, 95), 1),
+            "e2e_p99_ms": round(percentil(e2e, 99), 1), "ack_p50_ms": round(percentil(ack, 50), 1),
+            "ack_p95_ms": round(percentil(ack, 95), 1), "ack_p99_ms": round(percentil(ack, 99), 1),
+        })
+    if como_json:
+        print(json.dumps({"duracion_s": round(duracion, 2), "flujos": filas}, indent=2))
+        return
+    columnas = list(filas[0].keys()) if filas else []
+    print(f"Duración total: {duracion:.2f}s")
+    print("  ".join(f"{c:>14}" for c in columnas))
+    for fila in filas:
+        print("  ".join(f"{str(fila[c]):>14}" for c in columnas))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de ALIA con upstreams simulados")
+    parser.add_argument("--conversaciones", type=int, default=100)
+    parser.add_argument("--concurrencia", type=int, default=10)
+    parser.add_argument("--flujos", default=",".join(FLUJOS), help="lista separada por comas")
+    parser.add_argument("--openai-ms", type=float, default=0)
+    parser.add_argument("--sheets-ms", type=float, default=0)
+    parser.add_argument("--http-ms", type=float, default=0, help="latencia de Graph API y derivador")
+    parser.add_argument("--ocr-ms", type=float, default=0)
+    parser.add_argument("--redis-url", default=None, help="Redis real; si falta se usa fakeredis")
+    parser.add_argument("--target", default=None, help="URL de un servidor ya levantado")
+    parser.add_argument("--stub-port", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    flujos = [f.strip() for f in args.flujos.split(",") if f.strip()]
+    desconocidos = set(flujos) - set(FLUJOS)
+    if desconocidos:
+        parser.error(f"flujos desconocidos: {', '.join(sorted(desconocidos))}")
+
+    stub = StubUpstreams(port=args.stub_port, http_ms=args.http_ms, ocr_ms=args.ocr_ms).iniciar()
+    if args.target:
+        entorno = {}
+        stub.configurar_entorno(entorno)
+        print("Configurar el servidor con:", " ".join(f"{k}={v}" for k, v in entorno.items()), file=sys.stderr)
+        base_url = args.target.rstrip("/")
+    else:
+        base_url = levantar_app_local(args, stub)
+
+    res = Resultados()
+    sesion = requests.Session()
+    sesion.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=args.concurrencia))
+    prefijo = f"549{int(time.time()) % 100000:05d}"
+    inicio = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrencia) as pool:
+        futuros = [
+            pool.submit(conversar, i, flujos[i % len(flujos)], base_url, stub, res, args.timeout, sesion, prefijo)
+            for i in range(args.conversaciones)
+        ]
+        for f in futuros:
+            f.result()
+    imprimir_reporte(res, time.time() - inicio, args.json)
+    stub.detener()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+# Punto de entrada para medir la app bajo otro servidor (gunicorn, etc.)
+# con los fakes instalados:
+#
+#   BENCH_OPENAI_MS=800 BENCH_SHEETS_MS=300 GRAPH_API_URL=... OCR_SERVICE_URL=... \
+#       gunicorn -c gunicorn.conf.py bench.servidor:app
+#
+# Con más de un worker hace falta un Redis compartido (BENCH_REDIS_URL).
+import os
+
+from bench.fakes import instalar_fakes
+
+instalar_fakes(
+    float(os.getenv("BENCH_OPENAI_MS", "0")),
+    float(os.getenv("BENCH_SHEETS_MS", "0")),
+    os.getenv("BENCH_REDIS_URL")
+)
+
+# app se importa después de instalar los fakes (E402) y se reexporta para gunicorn
+from app import app  # noqa: E402
+
+__all__ = ["app"]
@@ -0,0 +1,100 @@
+# Servidor HTTP local que hace de Graph API (envíos y media), OCR y
+# derivador. Registra cada envío de WhatsApp para que el benchmark mida la
+# latencia de punta a punta (webhook -> respuesta enviada al paciente).
+import io
+import json
+import time
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+TEXTO_OCR = "Orden médica\nHemograma\nGlucemia\nColesterol total\nOSDE 210 Afiliado A123"
+
+def imagen_orden(semilla: int) -> bytes:
+    # Una imagen distinta por conversación para no pegarle al cache de OCR
+    img = Image.new("RGB", (1600, 1200), (255, 255, 255))
+    img.putpixel((semilla % 1600, (semilla // 1600) % 1200), (0, 0, 0))
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+class StubUpstreams:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, http_ms: float = 0, ocr_ms: float = 0):
+        self.http_s = http_ms / 1000
+        self.ocr_s = ocr_ms / 1000
+        self.envios = defaultdict(list)
+        self.cond = threading.Condition()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _json(self, data: dict, status: int = 200):
+                cuerpo = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def do_GET(self):
+                time.sleep(stub.http_s)
+                partes = self.path.split("?")[0].strip("/").split("/")
+                if partes[0] == "media":
+                    cuerpo = imagen_orden(int(partes[1]))
+                    self.send_response(200)
+                    self.send_header("Content-Type", "image/jpeg")
+                    self.send_header("Content-Length", str(len(cuerpo)))
+                    self.end_headers()
+                    self.wfile.write(cuerpo)
+                    return
+                # GET /graph/{media_id} -> metadatos con la URL de descarga
+                self._json({"url": f"{stub.url}/media/{partes[-1]}"})
+
+            def do_POST(self):
+                largo = int(self.headers.get("Content-Length") or 0)
+                data = json.loads(self.rfile.read(largo) or b"{}")
+                if self.path.startswith("/ocr"):
+                    time.sleep(stub.ocr_s)
+                    self._json({"text": TEXTO_OCR})
+                    return
+                time.sleep(stub.http_s)
+                if self.path.endswith("/messages"):
+                    with stub.cond:
+                        stub.envios[data.get("to")].append((time.time(), data["text"]["body"]))
+                        stub.cond.notify_all()
+                self._json({"ok": True})
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+
+    def iniciar(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def detener(self):
+        self.server.shutdown()
+
+    def esperar_respuesta(self, tel: str, cantidad_previa: int, timeout: float) -> float:
+        # Devuelve el momento en que llegó la primera respuesta nueva, o None
+        limite = time.time() + timeout
+        with self.cond:
+            while len(self.envios[tel]) <= cantidad_previa:
+                restante = limite - time.time()
+                if restante <= 0:
+                    return None
+                self.cond.wait(restante)
+            return self.envios[tel][cantidad_previa][0]
+
+    def cantidad_envios(self, tel: str) -> int:
+        with self.cond:
+            return len(self.envios[tel])
+
+    def configurar_entorno(self, environ: dict):
+        environ["GRAPH_API_URL"] = f"{self.url}/graph"
+        environ["OCR_SERVICE_URL"] = f"{self.url}/ocr"
+        environ["DERIVADOR_SERVICE_URL"] = f"{self.url}/derivar"
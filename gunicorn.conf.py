@@ -0,0 +1,46 @@
+# Servidor de producción: gunicorn con workers gthread (procesos x hilos).
+#
+#   gunicorn -c gunicorn.conf.py app:app
+#
+# Cada worker importa app por su cuenta (sin preload_app): la conexión a
+# Redis, las sesiones HTTP, los clientes de Google/OpenAI y el cache de
+# handles de Sheets son por proceso y se crean después del fork. Los límites
+# por proceso (OPENAI_CONCURRENCIA, HTTP_POOL_SIZE) se multiplican por
+# WEB_CONCURRENCY.
+import os
+
+bind                = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+workers             = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class        = "gthread"
+threads             = int(os.getenv("WEB_THREADS", "16"))
+timeout             = int(os.getenv("WEB_TIMEOUT", "120"))
+graceful_timeout    = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30"))
+keepalive           = int(os.getenv("WEB_KEEPALIVE", "5"))
+max_requests        = int(os.getenv("WEB_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("WEB_MAX_REQUESTS_JITTER", "0"))
+preload_app         = False
+
+def post_worker_init(worker):
+    # Flusher de Sheets, reconciliador de cupos, despachadores de WhatsApp y
+    # (si WEBHOOK_WORKERS_EN_WEB) workers de la cola del webhook
+    import signal
+    from app import iniciar_servicios, cerrar_eventos_chat
+    iniciar_servicios()
+
+    # Los streams SSE del widget no terminan solos: con SIGTERM se cierran
+    # antes de la espera de graceful_timeout y después sigue el handler de
+    # gunicorn (ya instalado en init_signals)
+    previo = signal.getsignal(signal.SIGTERM)
+
+    def al_terminar(signum, frame):
+        cerrar_eventos_chat()
+        if callable(previo):
+            previo(signum, frame)
+
+    signal.signal(signal.SIGTERM, al_terminar)
+
+def worker_exit(server, worker):
+    # Gunicorn ya esperó hasta graceful_timeout a los requests en curso; acá se
+    # cierran los hilos de fondo y se vuelca a Sheets lo pendiente
+    from app import detener_servicios
+    detener_servicios(graceful_timeout)